@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Caches
+
+import os
+import time
+import errno
+import cPickle
+import hashlib
+import threading
+import uuid
+
+from utils import LRU
+
+__all__ = ['Cache', 'MemoryCache', 'FileCache']
+
+
+class Cache(object):
+    """
+    Base class for caches. Subclasses implement ``_get``, ``set``, ``add``,
+    ``delete`` and ``clear``; hits and misses are counted here.
+
+    ``ttl`` is time in seconds after which item expires, None or 0 means
+    never (or cache's default ``ttl`` if given).
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def expires(self, ttl):
+        ttl = ttl or self.ttl
+        if ttl:
+            return time.time() + ttl
+        return None
+
+    def get(self, key, default=None):
+        """
+        Return cached value or ``default`` if key is missing or expired.
+        """
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value[0]
+
+    def peek(self, key, default=None):
+        """
+        Like ``get``, but hit or miss isn't counted (e.g. when cache is
+        polled).
+        """
+        value = self._get(key)
+        if value is None:
+            return default
+        return value[0]
+
+    def _get(self, key):
+        """
+        Return ``(value,)`` or None.
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def add(self, key, value, ttl=None):
+        """
+        Set value only if key isn't cached yet. Returns True if value was
+        set. It's atomic, so it can be used as a lock.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        Return dict with ``hits``, ``misses`` and ``hit_rate``.
+        """
+        (hits, misses) = (self.hits, self.misses)
+        total = hits + misses
+        return dict(hits=hits, misses=misses,
+                    hit_rate=total and float(hits) / total or 0.0)
+
+
+class MemoryCache(Cache):
+    """
+    In-process cache, only ``size`` most recently used items are kept.
+
+    :param size: Maximal number of items.
+    :param ttl: Default time to live in seconds.
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        Cache.__init__(self, ttl)
+        self.items = LRU(size)
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            return None
+        (expires, value) = item
+        if expires and expires < time.time():
+            self.items.pop(key)
+            return None
+        return (value,)
+
+    def set(self, key, value, ttl=None):
+        self.items[key] = (self.expires(ttl), value)
+
+    def add(self, key, value, ttl=None):
+        self._lock.acquire()
+        try:
+            if self._get(key) is not None:
+                return False
+            self.set(key, value, ttl)
+            return True
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self.items.pop(key)
+
+    def clear(self):
+        self.items.clear()
+
+
+class FileCache(Cache):
+    """
+    Cache which keeps every item in its own file, so it's shared by all
+    processes on the machine. Put it on tmpfs (e.g. ``/dev/shm``) to keep
+    it in shared memory. Files are sharded into subdirectories by hash of
+    the key.
+
+    :param path: Directory for cache files.
+    :param depth: Number of subdirectory levels.
+    :param ttl: Default time to live in seconds.
+    """
+
+    def __init__(self, path, depth=2, ttl=None):
+        Cache.__init__(self, ttl)
+        self.path = path
+        self.depth = depth
+
+    def filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h = hashlib.sha1(key).hexdigest()
+        parts = [h[i * 2:i * 2 + 2] for i in xrange(self.depth)]
+        return os.path.join(self.path, *(parts + [h]))
+
+    def _read(self, filename):
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                return cPickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+
+    def _get(self, key):
+        filename = self.filename(key)
+        item = self._read(filename)
+        if item is None:
+            return None
+        (expires, value) = item
+        if expires and expires < time.time():
+            self._unlink(filename)
+            return None
+        return (value,)
+
+    def _makedirs(self, filename):
+        folder = os.path.dirname(filename)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by other process in the meantime
+                pass
+
+    def _unlink(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+    def set(self, key, value, ttl=None):
+        filename = self.filename(key)
+        self._makedirs(filename)
+        # write to temporary file and rename it, so readers never see
+        # half-written item
+        tmp = '%s.%s.tmp' % (filename, uuid.uuid4().hex)
+        f = open(tmp, 'wb')
+        try:
+            cPickle.dump((self.expires(ttl), value), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+
+    def add(self, key, value, ttl=None):
+        filename = self.filename(key)
+        self._makedirs(filename)
+        for attempt in (0, 1):
+            try:
+                fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if attempt or self._get(key) is not None:
+                    return False
+                # expired item was removed by _get, try again
+                continue
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump((self.expires(ttl), value), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            return True
+        return False
+
+    def delete(self, key):
+        self._unlink(self.filename(key))
+
+    def clear(self):
+        for (root, dirs, files) in os.walk(self.path):
+            for name in files:
+                self._unlink(os.path.join(root, name))
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Request context
+
+import threading
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+from utils import Storage
+
+__all__ = ['current']
+
+
+class Context(object):
+    """
+    Objects of current request, e.g. ``current.request``. Every thread
+    (and every asyncio task, where ``contextvars`` are available) sees its
+    own values, so it is safe in threaded servers.
+
+    ``start`` is called by pygnite at the beginning of every request.
+    """
+
+    def __init__(self):
+        if ContextVar is not None:
+            self.__dict__['_var'] = ContextVar('pygnite_context', default=None)
+        else:
+            self.__dict__['_local'] = threading.local()
+
+    def _storage(self):
+        if ContextVar is not None:
+            return self._var.get()
+        return getattr(self._local, 'storage', None)
+
+    def start(self, **values):
+        """
+        Start new scope with ``values``.
+        """
+        storage = Storage(values)
+        if ContextVar is not None:
+            self._var.set(storage)
+        else:
+            self._local.storage = storage
+        return storage
+
+    def clear(self):
+        """
+        Forget values of current scope.
+        """
+        if ContextVar is not None:
+            self._var.set(None)
+        else:
+            self._local.storage = None
+
+    def __getattr__(self, key):
+        storage = self._storage()
+        if storage is None:
+            return None
+        return storage.get(key, None)
+
+    def __setattr__(self, key, value):
+        storage = self._storage()
+        if storage is None:
+            storage = self.start()
+        storage[key] = value
+
+
+current = Context()
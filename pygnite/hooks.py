@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Request hooks and WSGI middlewares
+
+import sys
+
+from http import Response
+
+__all__ = ['before_request', 'after_request', 'teardown', 'middleware']
+
+before_hooks = []
+after_hooks = []
+teardown_hooks = []
+middlewares = []
+
+
+def before_request(f):
+    """
+    Register function called before controller::
+
+        @before_request
+        def check(request):
+            if not request.session.get('user'):
+                return redirect('/login')
+
+    If it returns anything but None, it is used as response and controller
+    (and following ``before_request`` hooks) isn't called.
+    """
+    before_hooks.append(f)
+    return f
+
+def after_request(f):
+    """
+    Register function called with request and response returned by
+    controller. It may return new response, None keeps the old one::
+
+        @after_request
+        def powered_by(request, response):
+            response.headers['X-Powered-By'] = 'pygnite'
+    """
+    after_hooks.append(f)
+    return f
+
+def teardown(f):
+    """
+    Register function called at the end of every request, even if
+    controller raised an exception. It gets request and the exception (or
+    None). It's called when the server closes response body, so streamed
+    responses are already sent::
+
+        @teardown
+        def close(request, error):
+            pass
+    """
+    teardown_hooks.append(f)
+    return f
+
+def middleware(m, **conf):
+    """
+    Register WSGI middleware, ``m(app, **conf)`` has to return new WSGI
+    application. First registered middleware is the outermost one::
+
+        middleware(GzipMiddleware, compress_level=6)
+    """
+    middlewares.append((m, conf))
+    return m
+
+
+def _before(handler, hook):
+    def before(request, route):
+        response = hook(request)
+        if response is None:
+            return handler(request, route)
+        if isinstance(response, basestring):
+            response = Response(response)
+        return response
+    return before
+
+def _after(handler, hook):
+    def after(request, route):
+        response = handler(request, route)
+        new_response = hook(request, response)
+        if new_response is None:
+            return response
+        return new_response
+    return after
+
+def _teardown(next, hook):
+    def teardown(request, error):
+        try:
+            hook(request, error)
+        except:
+            next(request, sys.exc_info()[1])
+            raise
+        next(request, error)
+    return teardown
+
+def compose(handler):
+    """
+    Wrap ``handler(request, route)`` with registered hooks. It is done once
+    at startup, so requests just go through nested calls.
+    """
+    for hook in reversed(after_hooks):
+        handler = _after(handler, hook)
+    for hook in reversed(before_hooks):
+        handler = _before(handler, hook)
+    return handler
+
+def compose_teardown():
+    """
+    Chain registered teardown hooks into one ``function(request, error)``,
+    last registered is called first. Exception raised by a hook is passed
+    to the following ones.
+    """
+    teardown = lambda request, error: None
+    for hook in teardown_hooks:
+        teardown = _teardown(teardown, hook)
+    return teardown
+
+def wrap(app):
+    """
+    Wrap WSGI ``app`` with registered middlewares.
+    """
+    for (m, conf) in reversed(middlewares):
+        app = m(app, **conf)
+    return app
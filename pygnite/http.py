@@ -3,19 +3,41 @@
 import os
 import re
 import cgi
+import time
+import threading
 
 from httplib import responses
 
+from jinja2 import meta
+
 from utils import Storage, hash
-from template import append_path, render
+from cache import MemoryCache
+from template import env, append_path, render
+from session import Session, SESSION_KEY
 from main import IGNITE_PATH
 
 
-__all__ = ['routes', 'url', 'get', 'post', 'put', 'delete', 'Request', 'Response', 'Session', 'redirect', 'serve_static', '_404', '_500']
+__all__ = ['routes', 'find_route', 'url', 'get', 'post', 'put', 'delete', 'Request', 'Response', 'Session', 'cached', 'redirect', 'serve_static', '_404', '_500', 'error_stats']
 
 routes = Storage({ 'GET' : Storage(), 'POST' : Storage(), 'PUT' : Storage(), 'DELETE' : Storage() })
 
-def url(regex, methods=['*'], content_type='text/html'):
+# WSGI environ key for route matched before session middleware
+ROUTE_KEY = 'pygnite.route'
+
+def find_route(method, path):
+    """
+    Return ``((f, content_type, session), match)`` for first route matching
+    ``path`` or None.
+    """
+
+    _routes = routes.get(method) or {}
+    for route in _routes:
+        match = route.match(path)
+        if match is not None:
+            return (_routes[route], match)
+    return None
+
+def url(regex, methods=['*'], content_type='text/html', session=True):
     """
     Route decorator.
 
@@ -30,6 +52,7 @@ def url(regex, methods=['*'], content_type='text/html'):
     :param regex: Regexp for url path.
     :param methods: Lists of methods, if ['*'] match all. 
     :param content_type: Content Type of returned text. 
+    :param session: If False, request skips session middleware, so no session is loaded and no cookie is set (``request.session`` is None). 
 
     """
     def wrap(f):
@@ -67,7 +90,7 @@ def url(regex, methods=['*'], content_type='text/html'):
                         # Else u = regex (allow regexp in @url())
                         u = regex
 
-                    route = { re.compile(u) : (f, content_type) }
+                    route = { re.compile(u) : (f, content_type, session) }
                     routes[method].update(route)
         return f
     return wrap
@@ -166,33 +189,200 @@ class Request(Storage):
 
         return vars
 
+    @property
+    def session(self):
+        """
+        Session of current request. Backend loads it on first use, flash
+        message left by previous request is moved from it to ``flash``.
+        """
+        session = self.get(SESSION_KEY)
+        if session is not None and not 'flash' in self:
+            self['flash'] = None
+            if session.get('flash', None) is not None:
+                self['flash'] = session.pop('flash')
+        return session
+
+    @property
+    def flash(self):
+        """
+        Flash message left in session by previous request. It's removed
+        from session by next request which uses session, even if it isn't
+        read (requests which don't touch session don't load it).
+        """
+        self.session
+        return self.get('flash', None)
+
 class Response(object):
     """Pygnite response object"""
 
     def __init__(self, body='', content_type='text/html', status=200):
+        """
+        :param body: Body string or iterable of chunks (sent without Content-length).
+        :param content_type: Content Type.
+        :param status: Status.
+        """
         self.headers = Storage()
         self.body = body
         self.content_type = content_type
         self.status = get_response_status(status)
 
-    def __call__(self, env, start_response):
+    def finish(self):
+        """
+        Encode body and set headers. Returns False for streamed body.
+        """
         if not self.headers.has_key('Content-type'):
             self.headers['Content-type'] = self.content_type
+
+        if not isinstance(self.body, basestring):
+            return False
+
+        if self.headers['Content-type'].startswith('text') and isinstance(self.body, unicode):
+            self.body = self.body.encode('utf-8')
         if not self.headers.has_key('Content-length'):
             self.headers['Content-length'] = str(len(self.body))
+        return True
+
+    def __call__(self, env, start_response):
+        if not self.finish():
+            # streamed body, length is not known
+            start_response(self.status, self.headers.items())
+            if self.headers['Content-type'].startswith('text'):
+                return encode_chunks(self.body)
+            return self.body
 
         start_response(self.status, self.headers.items())
-        if self.headers['Content-type'].startswith('text'):
-            self.body = str(self.body.encode('utf-8'))
         return [ self.body ]
 
+def encode_chunks(chunks):
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        yield chunk
+
+
+def session_used(request):
+    """
+    Return True if ``request`` read or changed its session.
+    """
+    session = request.get(SESSION_KEY)
+    return session is not None and session.accessed()
+
+class cached(object):
+    """
+    Cache whole responses of controller. Use it together with ``url`` (or
+    shortcuts)::
+
+        @get('/news')
+        @cached(ttl=60, vary=['page'])
+        def news(request):
+            pass
+
+    Only GET requests and 200 responses with complete body (not streamed,
+    without cookies) are cached; on hit controller isn't called at all.
+    Responses of requests which used session (e.g. page showing user's
+    name) are never cached, they would be served to other users.
+    Missing or expired response is computed by only one worker, others
+    serve the old one for at most ``stale`` seconds meanwhile, or wait for
+    the new one (at most ``lock_timeout`` seconds) if there is none.
+
+    Responses are kept in ``cached.cache`` (``MemoryCache`` by default,
+    pass ``response_cache`` to ``pygnite()`` to use other ``Cache``).
+
+    :param ttl: Seconds response is fresh.
+    :param vary: Names of request vars which are part of cache key.
+    :param headers: Names of request headers which are part of cache key, e.g. ``['Accept-Language']``.
+    :param stale: Seconds expired response may be served while it is recomputed. Default: ``ttl``.
+    :param lock_timeout: Maximal time of recomputing response.
+    """
+
+    cache = MemoryCache(size=1000)
+    # seconds between checks while waiting for response computed by other worker
+    poll_interval = 0.05
+
+    def __init__(self, ttl=60, vary=[], headers=[], stale=None, lock_timeout=30):
+        self.ttl = ttl
+        self.vary = vary
+        self.headers = ['HTTP_' + h.upper().replace('-', '_') for h in headers]
+        self.stale = ttl if stale is None else stale
+        self.lock_timeout = lock_timeout
 
+    def __call__(self, f):
+        f.cache = self
+        return f
 
-class Session(Storage):
-    """Pygnite session object"""
+    def key(self, path, vars, env):
+        key = 'response:' + path
+        if self.vary:
+            key += '?' + '&'.join(['%s=%s' % (name, vars.get(name, '')) for name in self.vary])
+        if self.headers:
+            key += '|' + '|'.join([env.get(name, '') for name in self.headers])
+        return key
+
+    def response(self, request, call):
+        """
+        Return cached response for ``request`` or get new one by ``call``.
+        """
+        if request.method != 'GET':
+            return call()
+        key = self.key(request.path, request.vars, request)
+        item = self.cache.get(key)
+        if item is not None and item[0] > time.time():
+            return self.stored(item)
+        if not self.cache.add(key + ':lock', 1, self.lock_timeout):
+            # somebody else is computing it, serve stale response or wait
+            # for the new one
+            if item is None:
+                item = self.wait(key)
+            if item is not None:
+                return self.stored(item)
+            # not stored in time (or not cacheable), compute it without storing
+            return call()
+        try:
+            response = call()
+            if isinstance(response, Response) and response.finish() \
+                    and response.status.startswith('200') \
+                    and not response.headers.has_key('Set-Cookie') \
+                    and not session_used(request):
+                self.cache.set(key, (time.time() + self.ttl, response.status,
+                                     response.headers.items(), response.body),
+                               self.ttl + self.stale)
+            return response
+        finally:
+            self.cache.delete(key + ':lock')
+
+    def stored(self, item):
+        (expires, status, headers, body) = item
+        response = Response(body)
+        response.status = status
+        response.headers.update(headers)
+        return response
 
-    def __init__(self):
-        pass
+    def wait(self, key):
+        """
+        Wait (at most ``lock_timeout``) until worker holding the lock stores
+        response. Return stored item or None.
+        """
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            item = self.cache.peek(key)
+            if item is not None:
+                return item
+            if self.cache.peek(key + ':lock') is None:
+                # lock released, but response wasn't stored
+                return None
+        return None
+
+    def purge(self, path, vars={}, headers={}):
+        """
+        Remove cached response.
+
+        :param path: Path, e.g. ``/news``.
+        :param vars: Values of vars from ``vary``.
+        :param headers: Values of headers, e.g. ``{'Accept-Language': 'pl'}``.
+        """
+        env = dict([('HTTP_' + h.upper().replace('-', '_'), v) for (h, v) in headers.items()])
+        self.cache.delete(self.key(path, vars, env))
 
 def redirect(location, body='redirecting...', status=302, **kwds):
     """
@@ -244,15 +434,91 @@ def serve_static(static_path, indexes=False, f=None):
 
 append_path(IGNITE_PATH + '/templates/')
 
+# pre-rendered error pages: (status, template) => (template object, body)
+error_pages = {}
+# number of returned error pages per status
+error_counts = Storage()
+errors_locker = threading.Lock()
+
+def error_stats():
+    """
+    Return dict with number of error pages returned per status, e.g.
+    ``{404: 1200, 500: 2}``. Sudden growth means error storm (e.g. scanner
+    hitting random urls).
+    """
+    errors_locker.acquire()
+    try:
+        return dict(error_counts)
+    finally:
+        errors_locker.release()
+
+def _template_chain(template):
+    """
+    Return names of template and all templates it extends, includes or
+    imports, or None if some of them is chosen at runtime.
+    """
+    names = [template]
+    for name in names:
+        source = env.loader.get_source(env, name)[0]
+        for referenced in meta.find_referenced_templates(env.parse(source)):
+            if referenced is None:
+                return None
+            if not referenced in names:
+                names.append(referenced)
+    return names
+
+def _static_page(names):
+    """
+    True if none of templates uses request or session.
+    """
+    if names is None:
+        return False
+    for name in names:
+        source = env.loader.get_source(env, name)[0]
+        variables = meta.find_undeclared_variables(env.parse(source))
+        if 'request' in variables or 'session' in variables:
+            return False
+    return True
+
+def _error_page(status, template):
+    key = (status, template)
+    cached = error_pages.get(key)
+    if cached is not None:
+        (templates, page) = cached
+        if not env.auto_reload or not [t for t in templates if not t.is_up_to_date]:
+            if page is None:
+                return render(template, body='')
+            return page
+    page = render(template, body='')
+    if isinstance(page, unicode):
+        page = page.encode('utf-8')
+    # pages using request or session (in any template of the chain) differ
+    # between requests, so they are never cached
+    names = _template_chain(template)
+    templates = [env.get_template(name) for name in names or [template]]
+    if _static_page(names):
+        error_pages[key] = (templates, page)
+    else:
+        error_pages[key] = (templates, None)
+    return page
+
 def _status(status, template, body=''):
     """
-    Return response with specific status and template. 
+    Return response with specific status and template. Without ``body``,
+    page is rendered once and then served from cache until template changes.
 
     :param status: Response status, e.g. 500 or 404.
     :param template: Template name.
     :param body: Body.
     """
-    template = render(template, body=body)
+    errors_locker.acquire()
+    error_counts[status] = error_counts.get(status, 0) + 1
+    errors_locker.release()
+
+    if body:
+        template = render(template, body=body)
+    else:
+        template = _error_page(status, template)
     response= Response(body=template, status=status)
 
     return response
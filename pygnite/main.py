@@ -4,13 +4,17 @@
 import os
 import sys
 import traceback
+import types
 
 import server
 
-from beaker.middleware import SessionMiddleware
+from beaker.middleware import SessionMiddleware as BeakerMiddleware
 
 IGNITE_PATH = os.path.dirname(__file__)
 
+# set by pygnite()
+debug = True
+
 from utils import Storage, hash
 
 from http import *
@@ -19,51 +23,140 @@ from html import *
 from sqlhtml import *
 from validators import *
 from template import *
+from session import *
+from hooks import *
+from context import *
+from cache import *
+from session import SESSION_KEY, DEFAULT_SECRET, ClosingIterator
+from http import ROUTE_KEY, get_response_status
+from sql import SQLDB
+import hooks
+
+def call_controller(request, route):
+    """
+    Call controller of matched ``route`` and return response.
+    """
 
-def create_app(env, start_response):
-    global request, debug
-
-    request = Request(env)
-    request.session = env['beaker.session']
-    request.flash = request.session.get('flash', None)
-    request.session['flash'] = None
-
-    _routes = routes[request.method]
-    for route in _routes:
-        match = route.match(request.path)
-        if match is not None:
-            params = Storage()
-            params.update(match.groupdict())
-            params['all'] = match.groups()
+    ((f, content_type, session), match) = route
+    params = Storage()
+    params.update(match.groupdict())
+    params['all'] = match.groups()
+
+    def call():
+        try:
+            controller = f(request, params)
+        except TypeError:
+            controller = f(request)
+
+        response = current.response
+        if isinstance(controller, (basestring, types.GeneratorType)):
+            controller = Response(controller, content_type=content_type,
+                                  status=response.status or getattr(f, 'status', 200))
+            controller.headers.update(getattr(f, 'headers', {}))
+        elif isinstance(controller, Response) and response.status:
+            controller.status = get_response_status(response.status)
+        if isinstance(controller, Response):
+            # other WSGI applications (e.g. from serve_static or third party
+            # code) are called as they are
+            controller.headers.update(response.headers)
+
+        return controller
+
+    policy = getattr(f, 'cache', None)
+    if policy is not None:
+        # see http.cached
+        return policy.response(request, call)
+    return call()
+
+@teardown
+def close_databases(request, error):
+    """
+    Commit (or roll back, if controller failed) databases used by request
+    and give their connections back to the pool.
+    """
 
-            try:
-                (f, content_type) = _routes[route]
-                try:
-                    controller = f(request, params)
-                except TypeError:
-                    controller = f(request)
+    if error is None:
+        SQLDB.close_all_instances(SQLDB.commit)
+    else:
+        SQLDB.close_all_instances(SQLDB.rollback)
 
-                if isinstance(controller, basestring):
-                    controller = Response(controller, content_type=content_type, status=getattr(f, 'status', 200))
-                    controller.headers.update(getattr(f, 'headers', {}))
+def save_beaker_session(env):
+    """
+    Mark beaker session to be saved at the end of request if controller
+    changed it. Pygnite's own ``SessionMiddleware`` finds it out itself.
+    """
 
-                request.session.save()
-                return controller(env, start_response)
+    session = env.get(SESSION_KEY)
+    if session is None or isinstance(session, Session) or not session.accessed():
+        return
+    def data(items):
+        # beaker keeps its own values (e.g. _accessed_time) in session too
+        return dict([(k, v) for (k, v) in items if not k.startswith('_')])
+    if data(session.items()) != data(session.accessed_dict.items()):
+        session.save()
 
-            except:
-                t = ''.join(traceback.format_exception(*sys.exc_info()))
+# call_controller wrapped with hooks by pygnite()
+handler = call_controller
+# teardown hooks composed by pygnite()
+finish = lambda request, error: None
 
-                if debug == 'console':
-                    print t
-                if debug == 'www':
-                    return _500(t)(env, start_response)
-                if debug == True:
-                    print t
-                    return _500(t)(env, start_response)
+def create_app(env, start_response):
+    request = Request(env)
+    current.start(request=request, response=Storage(status=None, headers=Storage()))
+
+    if ROUTE_KEY in env:
+        # already matched by stateless_app
+        found = env[ROUTE_KEY]
+    else:
+        found = find_route(request.method, request.path)
+    if found is None:
+        return _404()(env, start_response)
+
+    try:
+        controller = handler(request, found)
+        save_beaker_session(env)
+
+        result = controller(env, start_response)
+
+    except:
+        t = ''.join(traceback.format_exception(*sys.exc_info()))
+        try:
+            finish(request, sys.exc_info()[1])
+        except:
+            t += ''.join(traceback.format_exception(*sys.exc_info()))
+
+        if debug == 'console':
+            print t
+        if debug == 'www':
+            return _500(t)(env, start_response)
+        if debug == True:
+            print t
+            return _500(t)(env, start_response)
+
+        return _500()(env, start_response)
+
+    # streamed body may still use databases, teardown hooks are called
+    # after it's sent
+    body = ClosingIterator(result, lambda: finish(request, body.error))
+    return body
+
+
+def stateless_app(app, session_app):
+    """
+    Returns WSGI app which matches route once and sends requests for routes
+    declared with ``session=False`` straight to ``app``, so session
+    middleware (and its cookie) is skipped. Other requests go to
+    ``session_app``.
+    """
 
-                return _500()(env, start_response)
+    def dispatch(env, start_response):
+        found = find_route(env['REQUEST_METHOD'], env.get('PATH_INFO') or env.get('REQUEST_URI', '/'))
+        env[ROUTE_KEY] = found
+        if found is not None and not found[0][2]:
+            return app(env, start_response)
+        return session_app(env, start_response)
 
-    return _404()(env, start_response)
+    return dispatch
 
 
 def pygnite(**conf):
@@ -75,11 +168,18 @@ def pygnite(**conf):
     :param port: Port.
     :param server_conf: Extra server configuration.
     :param templates_path: Path to templates.
+    :param template_cache: Directory for compiled templates cache. Default: None (no cache on disk).
+    :param template_cache_size: Number of compiled templates kept in memory, -1 means all.
+    :param template_precompile: If True, compile all templates before server starts.
+    :param fragment_cache: Cache for ``{% cache %}`` template fragments (see cache module).
+    :param response_cache: Cache for responses of ``@cached`` controllers. Default: ``MemoryCache``.
     :param session_key: Session key.
-    :param session_secret: Session secret.
+    :param session_secret: Session secret, required by ``cookie`` backend.
+    :param session_backend: Session backend: ``beaker`` (default), ``cookie``, ``memory``, ``file``, ``store`` or ``SessionBackend`` instance.
+    :param session_conf: Extra session backend configuration, e.g. ``path`` for ``file`` backend or ``store`` for ``store`` backend.
     :param debug: if debug is True, show traceback in console and www, if console - only console, if www - only www. Default: True.
     """
-    global debug
+    global debug, handler, finish
 
     ## Conf to var assignment
     # Serving conf
@@ -90,9 +190,18 @@ def pygnite(**conf):
     # templates path. ofc you can add it manually by template.append_path
     templates_path = conf.get('templates_path', os.path.join(sys.path[0], 'templates'))
     append_path(templates_path)
+    template_cache = conf.get('template_cache', None)
+    template_cache_size = conf.get('template_cache_size', None)
+    template_precompile = conf.get('template_precompile', False)
+    fragment_cache = conf.get('fragment_cache', None)
+    # Responses cache
+    if conf.get('response_cache', None) is not None:
+        cached.cache = conf['response_cache']
     # Session config
     session_key = conf.get('session_key', 'mysession')
-    session_secret = conf.get('session_secret', 'randomsecret')
+    session_secret = conf.get('session_secret', DEFAULT_SECRET)
+    backend = conf.get('session_backend', 'beaker')
+    session_conf = conf.get('session_conf', {})
     # debug:
     debug = conf.get('debug', True)
 
@@ -101,7 +210,31 @@ def pygnite(**conf):
         mode = 'dev'
 
     ## Session middleware:
-    app = SessionMiddleware(create_app, key=session_key, secret=session_secret)
+    if backend == 'beaker':
+        # session is saved by save_beaker_session only if request changed
+        # it, reading it doesn't rewrite it
+        session_conf.setdefault('save_accessed_time', False)
+        app = BeakerMiddleware(create_app, key=session_key, secret=session_secret,
+                               environ_key=SESSION_KEY, **session_conf)
+    else:
+        if isinstance(backend, basestring):
+            backend = session_backend(backend, **session_conf)
+        app = SessionMiddleware(create_app, backend, key=session_key, secret=session_secret)
+    app = stateless_app(create_app, app)
+
+    ## Hooks and middlewares are composed once, here
+    handler = hooks.compose(call_controller)
+    finish = hooks.compose_teardown()
+    app = hooks.wrap(app)
+
+    ## Connections opened while application was imported (e.g. by
+    ## define_table) go back to the pool
+    SQLDB.close_all_instances(SQLDB.commit)
+
+    ## Templates: outside dev mode files are not checked for changes
+    configure_templates(cache_path=template_cache, auto_reload=(mode == 'dev'),
+                        cache_size=template_cache_size, precompile=template_precompile,
+                        fragment_cache=fragment_cache)
 
     if mode == 'dev' and not server_conf.has_key('auto_reload'):
         server_conf['auto_reload'] = True
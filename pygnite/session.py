@@ -0,0 +1,519 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Sessions
+
+import os
+import re
+import sys
+import time
+import hmac
+import base64
+import cPickle
+import hashlib
+import threading
+import uuid
+import logging
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from Cookie import SimpleCookie
+
+from utils import Storage, LRU
+
+__all__ = ['Session', 'SessionMiddleware', 'SessionBackend', 'CookieBackend',
+           'MemoryBackend', 'FileBackend', 'StoreBackend', 'LocalStore',
+           'session_backend']
+
+# WSGI environ key under which current session is stored
+SESSION_KEY = 'pygnite.session'
+
+# browsers refuse cookies bigger than 4kB
+MAX_COOKIE_SIZE = 4093
+
+# default secret of SessionMiddleware and pygnite(), anyone can sign with it
+DEFAULT_SECRET = 'randomsecret'
+
+regex_id = re.compile('^[0-9a-f]{32}$')
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+def dumps(data):
+    return cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+    return cPickle.loads(data)
+
+
+class Session(Storage):
+    """
+    Pygnite session object.
+
+    Session is loaded by ``loader`` on first access and is stored by session
+    backend at the end of request only if it was changed. Call ``save`` if
+    you modify mutable object kept in session.
+    """
+
+    def __init__(self, id=None, data=None, loader=None):
+        self.__dict__['id'] = id or new_id()
+        self.__dict__['new'] = data is None and loader is None
+        self.__dict__['_loader'] = loader
+        self.__dict__['_dirty'] = False
+        self.__dict__['_accessed'] = False
+        self.__dict__['_invalidated'] = False
+        if data:
+            dict.update(self, data)
+
+    def _load(self):
+        loader = self.__dict__['_loader']
+        if loader is None:
+            return
+        self.__dict__['_loader'] = None
+        data = loader()
+        if not isinstance(data, dict):
+            # expired or unknown session, start new one
+            self.__dict__['id'] = new_id()
+            self.__dict__['new'] = True
+        else:
+            dict.update(self, data)
+
+    @property
+    def loaded(self):
+        return self.__dict__['_loader'] is None
+
+    @property
+    def dirty(self):
+        return self.__dict__['_dirty']
+
+    def accessed(self):
+        """
+        Return True if request read or changed session (like beaker's
+        ``accessed``).
+        """
+        return self.__dict__['_accessed'] or self.__dict__['_dirty']
+
+    def save(self):
+        """
+        Mark session to be stored at the end of request.
+        """
+        self._load()
+        self.__dict__['_dirty'] = True
+
+    def invalidate(self):
+        """
+        Clear session and give it a new id.
+        """
+        self._load()
+        dict.clear(self)
+        self.__dict__['_invalidated'] = self.id
+        self.__dict__['id'] = new_id()
+        self.save()
+
+    delete = invalidate
+
+    def _saved(self):
+        self.__dict__['_dirty'] = False
+        self.__dict__['_invalidated'] = False
+        self.__dict__['new'] = False
+
+def _lazy(name, writes=False):
+    method = getattr(dict, name)
+    def wrapper(self, *args, **kwds):
+        self.__dict__['_accessed'] = True
+        if self.__dict__['_loader'] is not None:
+            self._load()
+        if writes:
+            self.__dict__['_dirty'] = True
+        return method(self, *args, **kwds)
+    wrapper.__name__ = name
+    return wrapper
+
+for name in ['__getitem__', '__contains__', '__iter__', '__len__', '__repr__',
+             'get', 'has_key', 'keys', 'values', 'items', 'iterkeys',
+             'itervalues', 'iteritems', 'copy']:
+    setattr(Session, name, _lazy(name))
+for name in ['__setitem__', '__delitem__', 'pop', 'popitem', 'setdefault',
+             'update', 'clear']:
+    setattr(Session, name, _lazy(name, writes=True))
+del name
+
+
+class SessionBackend(object):
+    """
+    Base class for session backends.
+
+    ``load`` gets session id and returns dict of data or None if there is no
+    such session, ``save`` stores data and returns value which will be sent
+    to client in cookie (usually just session id).
+    """
+
+    def load(self, id):
+        raise NotImplementedError
+
+    def save(self, id, data):
+        raise NotImplementedError
+
+    def delete(self, id):
+        pass
+
+
+class CookieBackend(SessionBackend):
+    """
+    Keeps whole session in client's cookie, so nothing is stored on server.
+    Cookie is signed by ``SessionMiddleware``, which refuses to use this
+    backend with default secret. Session is serialized as JSON, so it can
+    keep only strings, numbers, lists, dicts, booleans and None.
+
+    :param timeout: Seconds after session expires. Default: never.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def load(self, value):
+        try:
+            (stamp, data) = json.loads(base64.urlsafe_b64decode(str(value) + '=' * (-len(value) % 4)))
+        except Exception:
+            return None
+        if not isinstance(data, dict) or not isinstance(stamp, (int, long)):
+            return None
+        if self.timeout and stamp + self.timeout < time.time():
+            return None
+        return data
+
+    def save(self, id, data):
+        if not data:
+            return ''
+        return base64.urlsafe_b64encode(json.dumps([int(time.time()), data],
+                                                   separators=(',', ':'))).rstrip('=')
+
+
+class MemoryBackend(SessionBackend):
+    """
+    Keeps sessions in process memory, oldest sessions are dropped when there
+    are more than ``size`` of them. Good for single process servers.
+
+    :param size: Maximal number of sessions.
+    :param timeout: Seconds after session expires. Default: never.
+    """
+
+    def __init__(self, size=10000, timeout=None):
+        self.timeout = timeout
+        self.sessions = LRU(size)
+
+    def load(self, id):
+        item = self.sessions.get(id)
+        if item is None:
+            return None
+        (stamp, data) = item
+        if self.timeout and stamp + self.timeout < time.time():
+            self.sessions.pop(id)
+            return None
+        return loads(data)
+
+    def save(self, id, data):
+        self.sessions[id] = (time.time(), dumps(data))
+        return id
+
+    def delete(self, id):
+        self.sessions.pop(id)
+
+
+class FileBackend(SessionBackend):
+    """
+    Keeps every session in its own file. Files are sharded into
+    subdirectories by first characters of session id
+    (``path/ab/cd/abcd...``), so directories stay small.
+
+    :param path: Directory for session files.
+    :param depth: Number of subdirectory levels.
+    :param timeout: Seconds after session expires. Default: never.
+    """
+
+    def __init__(self, path, depth=2, timeout=None):
+        self.path = path
+        self.depth = depth
+        self.timeout = timeout
+
+    def filename(self, id):
+        if not regex_id.match(id):
+            raise ValueError('invalid session id')
+        parts = [id[i * 2:i * 2 + 2] for i in xrange(self.depth)]
+        return os.path.join(self.path, *(parts + [id]))
+
+    def load(self, id):
+        try:
+            filename = self.filename(id)
+            if self.timeout and os.path.getmtime(filename) + self.timeout < time.time():
+                os.unlink(filename)
+                return None
+            f = open(filename, 'rb')
+        except (ValueError, OSError, IOError):
+            return None
+        try:
+            try:
+                return loads(f.read())
+            except Exception:
+                return None
+        finally:
+            f.close()
+
+    def save(self, id, data):
+        filename = self.filename(id)
+        folder = os.path.dirname(filename)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by other process in the meantime
+                pass
+        # write to temporary file and rename it, so readers never see
+        # half-written session
+        tmp = '%s.%s.tmp' % (filename, new_id())
+        f = open(tmp, 'wb')
+        try:
+            f.write(dumps(data))
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        return id
+
+    def delete(self, id):
+        try:
+            os.unlink(self.filename(id))
+        except (ValueError, OSError):
+            pass
+
+
+class StoreBackend(SessionBackend):
+    """
+    Keeps sessions in shared store, so every process (or machine) sees
+    the same sessions. Store has to provide memcache-like API:
+    ``get(key)``, ``set(key, value, time)`` and ``delete(key)``, e.g.
+    ``memcache.Client`` or ``LocalStore``.
+
+    :param store: Store object.
+    :param timeout: Seconds after session expires. Default: never.
+    :param prefix: Prefix of keys in store.
+    """
+
+    def __init__(self, store, timeout=None, prefix='session:'):
+        self.store = store
+        self.timeout = timeout
+        self.prefix = prefix
+
+    def load(self, id):
+        data = self.store.get(self.prefix + id)
+        if data is None:
+            return None
+        return loads(data)
+
+    def save(self, id, data):
+        self.store.set(self.prefix + id, dumps(data), self.timeout or 0)
+        return id
+
+    def delete(self, id):
+        self.store.delete(self.prefix + id)
+
+
+_now = time.time
+
+class LocalStore(object):
+    """
+    In-process store with memcache-like API. Use it with ``StoreBackend``
+    in tests and development instead of real shared store.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        (expires, value) = item
+        if expires and expires < time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, time=0):
+        expires = time and _now() + time
+        self._lock.acquire()
+        self._data[key] = (expires, value)
+        self._lock.release()
+        return True
+
+    def delete(self, key):
+        self._lock.acquire()
+        self._data.pop(key, None)
+        self._lock.release()
+        return True
+
+BACKENDS = {
+    'cookie': CookieBackend,
+    'memory': MemoryBackend,
+    'file': FileBackend,
+    'store': StoreBackend,
+}
+
+def session_backend(name, **conf):
+    """
+    Return session backend by name.
+
+    :param name: One of ``cookie``, ``memory``, ``file``, ``store``.
+    :param conf: Backend configuration.
+    """
+
+    if not name in BACKENDS:
+        raise ValueError('unknown session backend: %s' % name)
+    return BACKENDS[name](**conf)
+
+
+class SessionMiddleware(object):
+    """
+    WSGI middleware which puts session object to ``environ`` and stores it
+    with ``backend`` at the end of request, unless the response is an error
+    (5xx status). Cookie with session id (or whole session in case of
+    ``CookieBackend``) is signed with ``secret``.
+
+    :param app: WSGI application.
+    :param backend: Session backend.
+    :param key: Cookie name.
+    :param secret: Secret used to sign cookie.
+    :param path: Cookie path.
+    :param domain: Cookie domain.
+    :param secure: Send cookie only over https.
+    :param httponly: Hide cookie from javascript.
+    """
+
+    def __init__(self, app, backend, key='mysession', secret=DEFAULT_SECRET,
+                 path='/', domain=None, secure=False, httponly=True):
+        if isinstance(backend, CookieBackend) and (not secret or secret == DEFAULT_SECRET):
+            raise ValueError('cookie session backend needs session_secret')
+        self.app = app
+        self.backend = backend
+        self.key = key
+        self.secret = secret
+        self.path = path
+        self.domain = domain
+        self.secure = secure
+        self.httponly = httponly
+
+    def sign(self, value):
+        return hmac.new(self.secret, value, hashlib.sha1).hexdigest()
+
+    def read_cookie(self, env):
+        header = env.get('HTTP_COOKIE')
+        if not header or not self.key in header:
+            return None
+        try:
+            morsel = SimpleCookie(header).get(self.key)
+        except Exception:
+            return None
+        if morsel is None:
+            return None
+        (signature, value) = (morsel.value[:40], morsel.value[40:])
+        if not value or not hmac.compare_digest(self.sign(value), signature):
+            return None
+        return value
+
+    def make_cookie(self, value):
+        cookie = '%s=%s%s; Path=%s' % (self.key, self.sign(value), value, self.path)
+        if len(cookie) > MAX_COOKIE_SIZE:
+            raise ValueError('session cookie is too large')
+        if not value:
+            cookie = '%s=; Path=%s; Expires=Thu, 01 Jan 1970 00:00:00 GMT' % (self.key, self.path)
+        if self.domain:
+            cookie += '; Domain=%s' % self.domain
+        if self.secure:
+            cookie += '; Secure'
+        if self.httponly:
+            cookie += '; HttpOnly'
+        return cookie
+
+    def load(self, env):
+        value = self.read_cookie(env)
+        if value is None:
+            return Session()
+        # backend is not asked until session is really used
+        return Session(value, loader=lambda: self.backend.load(value))
+
+    def persist(self, session):
+        """
+        Store session and return cookie header or None if there is no need
+        to send it.
+        """
+
+        if not session.dirty:
+            return None
+        if session._invalidated:
+            self.backend.delete(session._invalidated)
+        value = self.backend.save(session.id, dict(session))
+        if value == session.id and not session.new and not session._invalidated:
+            # client already has this cookie
+            cookie = None
+        elif not value and session.new:
+            cookie = None
+        else:
+            cookie = self.make_cookie(value)
+        session._saved()
+        return cookie
+
+    def __call__(self, env, start_response):
+        session = env[SESSION_KEY] = self.load(env)
+        failed = []
+
+        def session_start_response(status, headers, exc_info=None):
+            if exc_info or status.startswith('5'):
+                # request failed (and its transaction was rolled back), so
+                # its changes of session are dropped
+                failed.append(status)
+                return start_response(status, headers, exc_info)
+            cookie = self.persist(session)
+            if cookie:
+                headers.append(('Set-Cookie', cookie))
+            return start_response(status, headers, exc_info)
+
+        def close():
+            # session changed while streamed body was iterated
+            if not failed and self.persist(session):
+                logging.warning('session changed after headers were sent, '
+                                'new cookie is lost')
+
+        return ClosingIterator(self.app(env, session_start_response), close)
+
+
+class ClosingIterator(object):
+    """
+    Iterable returned to WSGI server, which calls ``callback`` after
+    ``close`` of wrapped iterable. Exception raised while iterating is kept
+    in ``error``.
+    """
+
+    error = None
+
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.callback = callback
+
+    def __iter__(self):
+        try:
+            for chunk in self.iterable:
+                yield chunk
+        except:
+            self.error = sys.exc_info()[1]
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.callback()
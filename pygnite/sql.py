@@ -13,7 +13,9 @@ import os
 import types
 import cPickle
 import datetime
+import time
 import thread
+import threading
 import cStringIO
 import csv
 import copy
@@ -22,8 +24,21 @@ import logging
 import copy_reg
 import base64
 import hashlib
+import uuid
+import collections
+import array
 
-from utils import hash
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from utils import hash, LRU
 
 table_field = re.compile('[\w_]+\.[\w_]+')
 oracle_fix = re.compile("[^']*('[^']*'[^']*)*\:(?P<clob>CLOB\('([^']+|'')*'\))")
@@ -81,8 +96,9 @@ except:
 import validators
 
 sql_locker = thread.allocate_lock()
+pool_locker = thread.allocate_lock()
 
-def database(engine='sqlite3', db='database.db', host=None, username=None, password=None, port=None):
+def database(engine='sqlite3', db='database.db', host=None, username=None, password=None, port=None, pool_size=10, **pool):
     """This function is wrapper which returns ``SQLDB`` known from web2py.
 
     :param engine: Database engine, e.g. ``sqlite3`` or ``mysql``. 
@@ -91,6 +107,8 @@ def database(engine='sqlite3', db='database.db', host=None, username=None, passw
     :param username: Usename.
     :param password: Password.
     :param port: Port.
+    :param pool_size: Number of idle connections kept for reuse. Every thread (request) uses its own connection, which is given back at the end of request.
+    :param pool: Other pool settings passed to ``SQLDB``: ``pool_min``, ``pool_max``, ``pool_timeout``, ``pool_max_age``, ``pool_max_idle`` and ``pool_ping_after``.
     """
     if engine == 'sqlite3':
         if not db.startswith('/'):
@@ -103,14 +121,14 @@ def database(engine='sqlite3', db='database.db', host=None, username=None, passw
         else:
             db_path = db
 
-        return SQLDB('sqlite://%s' % db_path)
+        return SQLDB('sqlite://%s' % db_path, pool_size=pool_size, **pool)
     elif engine == 'oracle':
-        return SQLDB('oracle://%s/%s@%s' % (username, password, db))
+        return SQLDB('oracle://%s/%s@%s' % (username, password, db), pool_size=pool_size, **pool)
     else:
         if port is not None:
-            return SQLDB('%s://%s:%s@%s:%s/%s' % (engine, username, password, host or 'localhost', port, db))
+            return SQLDB('%s://%s:%s@%s:%s/%s' % (engine, username, password, host or 'localhost', port, db), pool_size=pool_size, **pool)
         else:
-            return SQLDB('%s://%s:%s@%s/%s' % (engine, username, password, host or 'localhost', db))
+            return SQLDB('%s://%s:%s@%s/%s' % (engine, username, password, host or 'localhost', db), pool_size=pool_size, **pool)
 
 SQL_DIALECTS = {
     'sqlite': {
@@ -136,6 +154,10 @@ SQL_DIALECTS = {
         'random': 'Random()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1',
+        'placeholder': '?',
+        'insert_rows': 500,
+        'max_params': 999,
         },
     'mysql': {
         'boolean': 'CHAR(1)',
@@ -160,6 +182,10 @@ SQL_DIALECTS = {
         'random': 'RAND()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1',
+        'placeholder': '%%s',
+        'insert_rows': 1000,
+        'max_params': 65535,
         },
     'postgres': {
         'boolean': 'CHAR(1)',
@@ -184,6 +210,10 @@ SQL_DIALECTS = {
         'random': 'RANDOM()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1',
+        'placeholder': '%%s',
+        'insert_rows': 1000,
+        'max_params': 32767,
         },
     'oracle': {
         'boolean': 'CHAR(1)',
@@ -208,6 +238,10 @@ SQL_DIALECTS = {
         'random': 'dbms_random.value',
         'notnull': 'DEFAULT %(default)s NOT NULL',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1 FROM DUAL',
+        'placeholder': ':%(n)s',
+        'insert_rows': 0,
+        'max_params': 0,
         },
     'mssql': {
         'boolean': 'BIT',
@@ -232,6 +266,10 @@ SQL_DIALECTS = {
         'random': 'NEWID()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1',
+        'placeholder': '?',
+        'insert_rows': 1000,
+        'max_params': 2000,
         },
     'mssql2': {
         'boolean': 'CHAR(1)',
@@ -256,6 +294,10 @@ SQL_DIALECTS = {
         'random': 'NEWID()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1',
+        'placeholder': '?',
+        'insert_rows': 1000,
+        'max_params': 2000,
         },
     'firebird': {
         'boolean': 'CHAR(1)',
@@ -280,6 +322,10 @@ SQL_DIALECTS = {
         'random': 'RANDOM()',
         'notnull': 'DEFAULT %(default)s NOT NULL',
         'substring': 'SUBSTRING(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1 FROM RDB$DATABASE',
+        'placeholder': '?',
+        'insert_rows': 0,
+        'max_params': 0,
         },
     'informix': {
         'boolean': 'CHAR(1)',
@@ -304,6 +350,10 @@ SQL_DIALECTS = {
         'random': 'RANDOM()',
         'notnull': 'DEFAULT %(default)s NOT NULL',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1 FROM systables WHERE tabid=1',
+        'placeholder': ':%(n)s',
+        'insert_rows': 0,
+        'max_params': 0,
         },
     'db2': {
         'boolean': 'CHAR(1)',
@@ -328,6 +378,10 @@ SQL_DIALECTS = {
         'random': 'RAND()',
         'notnull': 'NOT NULL DEFAULT %(default)s',
         'substring': 'SUBSTR(%(field)s,%(pos)s,%(length)s)',
+        'ping': 'SELECT 1 FROM SYSIBM.SYSDUMMY1',
+        'placeholder': '?',
+        'insert_rows': 1000,
+        'max_params': 32767,
         },
     }
 
@@ -427,6 +481,183 @@ def sql_represent(obj, fieldtype, dbname):
     return "'%s'" % obj.replace("'", "''")
 
 
+def sql_template(fieldtype, dbname):
+    """
+    returns SQL around placeholder of value of fieldtype or None
+    """
+
+    if fieldtype == 'blob' and dbname == 'db2':
+        return 'BLOB(%s)'
+    if fieldtype == 'date' and dbname in ['oracle', 'informix']:
+        return "to_date(%s,'yyyy-mm-dd')"
+    if fieldtype == 'datetime' and dbname in ['oracle', 'informix']:
+        return "to_date(%s,'yyyy-mm-dd hh24:mi:ss')"
+    return None
+
+
+def sql_param(obj, fieldtype, dbname):
+    """
+    like sql_represent, but returns value which is passed to database
+    driver as parameter (see also sql_template)
+    """
+
+    if obj is None:
+        return None
+    if obj == '' and fieldtype[:2] in ['id', 'in', 're', 'da', 'ti', 'bo']:
+        return None
+    if fieldtype == 'boolean':
+        true = obj and not str(obj)[0].upper() == 'F'
+        if dbname == 'mssql':
+            return true and 1 or 0
+        return true and 'T' or 'F'
+    if fieldtype[0] == 'i' or fieldtype[0] == 'r':
+        return int(obj)
+    elif fieldtype == 'double':
+        return float(obj)
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    if fieldtype == 'blob':
+        obj = base64.b64encode(str(obj))
+    elif fieldtype == 'date':
+        if isinstance(obj, (datetime.date, datetime.datetime)):
+            obj = obj.strftime('%Y-%m-%d')
+        else:
+            obj = str(obj)
+    elif fieldtype == 'datetime':
+        if isinstance(obj, datetime.datetime):
+            if dbname == 'db2':
+                obj = obj.strftime('%Y-%m-%d-%H.%M.%S')
+            else:
+                obj = obj.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(obj, datetime.date):
+            if dbname == 'db2':
+                obj = obj.strftime('%Y-%m-%d-00.00.00')
+            else:
+                obj = obj.strftime('%Y-%m-%d 00:00:00')
+        else:
+            obj = str(obj)
+    elif fieldtype == 'time':
+        if isinstance(obj, datetime.time):
+            obj = obj.strftime('%H:%M:%S')
+        else:
+            obj = str(obj)
+    else:
+        obj = str(obj)
+    if dbname == 'sqlite' or dbname == 'mssql2' and fieldtype in ['string', 'text']:
+        # sqlite refuses 8-bit strings, mssql2 wants N'' strings
+        obj = obj.decode('utf-8')
+    return obj
+
+
+class SQLParam(object):
+
+    """
+    value in query, it's sent to database as parameter of statement (see
+    SQLDB._compile) and rendered as literal only for debugging
+    """
+
+    __slots__ = ('value', 'type', 'dbname')
+
+    def __init__(self, value, type, dbname):
+        (self.value, self.type, self.dbname) = (value, type, dbname)
+
+    def __str__(self):
+        return sql_represent(self.value, self.type, self.dbname)
+
+
+def sql_value(obj, fieldtype, dbname):
+    """
+    returns part of statement for value: SQLParam or literal SQL for
+    expressions and custom types
+    """
+
+    if isinstance(obj, SQLXorable) or isinstance(fieldtype, SQLCustomType):
+        return str(sql_represent(obj, fieldtype, dbname))
+    return SQLParam(obj, fieldtype, dbname)
+
+
+def sql_parts(obj):
+    """
+    returns list of parts of statement: strings and SQLParams
+    """
+
+    if isinstance(obj, list):
+        return list(obj)
+    if isinstance(obj, SQLParam):
+        return [obj]
+    if hasattr(obj, 'parts'):
+        return list(obj.parts)
+    return [str(obj)]
+
+
+def join_parts(items, separator):
+    parts = []
+    for item in items:
+        if parts:
+            parts.append(separator)
+        parts += sql_parts(item)
+    return parts
+
+
+def sql_shape(obj, params):
+    """
+    returns hashable shape of query, join, field, list of them etc.: their
+    SQL without values, values (SQLParams) are appended to params
+    """
+
+    if isinstance(obj, SQLParam):
+        params.append(obj)
+        return (obj.type, )
+    if isinstance(obj, (list, tuple)):
+        return tuple([sql_shape(item, params) for item in obj])
+    if isinstance(obj, SQLQuery):
+        (shape, values) = obj._shape()
+        params.extend(values)
+        return shape
+    if isinstance(obj, (SQLJoin, SQLStatement)):
+        return (obj.__class__.__name__, sql_shape(obj.parts, params))
+    return str(obj)
+
+
+def sql_tables(obj):
+    """
+    returns names of tables used by field, expression, query etc.
+    """
+
+    if isinstance(obj, (basestring, SQLTable)):
+        return parse_tablenames(str(obj))
+    tables = getattr(obj, '_tables', None)
+    if tables is None:
+        return parse_tablenames(str(obj))
+    return tables
+
+
+def merge_tables(*names):
+    tables = []
+    for items in names:
+        for name in items:
+            if not name in tables:
+                tables.append(name)
+    return tables
+
+
+class SQLStatement(object):
+
+    """
+    SQL statement returned by _select, _insert etc.; str() gives SQL with
+    values as literals, parts are passed to SQLDB._compile
+    """
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __str__(self):
+        return ''.join([str(part) for part in self.parts])
+
+    def __repr__(self):
+        return repr(str(self))
+
+
 def cleanup(text):
     if re.compile('[^0-9a-zA-Z_]').findall(text):
         raise SyntaxError, \
@@ -449,7 +680,9 @@ def sqlite3_web2py_extract(lookup, s):
     except:
         return None
 
-def oracle_fix_execute(command, execute):
+def oracle_fix_execute(command, execute, params=None):
+    if params:
+        return execute(command[:-1], params)
     args = []
     i = 1
     while True:
@@ -525,6 +758,251 @@ class SQLStorage(dict):
         return '<SQLStorage ' + dict.__repr__(self) + '>'
 
 
+class SQLLocal(threading.local):
+
+    """
+    connection and cursor of SQLDB, separate for every thread
+    """
+
+    connection = None
+    cursor = None
+
+
+class SQLShared(object):
+
+    """
+    connection of SQLDB shared by all threads, every thread uses its own
+    cursor
+    """
+
+    def __init__(self):
+        self.connection = None
+        self._cursors = threading.local()
+
+    def _get_cursor(self):
+        cursor = getattr(self._cursors, 'cursor', None)
+        if cursor is None and self.connection is not None:
+            cursor = self._cursors.cursor = self.connection.cursor()
+        return cursor
+
+    def _set_cursor(self, cursor):
+        self._cursors.cursor = cursor
+
+    cursor = property(_get_cursor, _set_cursor)
+
+
+class SQLPoolTimeout(Exception):
+
+    """
+    raised when no connection was given back to the pool in time
+    """
+
+    pass
+
+
+class SQLConnectionPool(object):
+
+    """
+    a pool of connections to one database
+
+    connect: function which makes new connection
+    ping: function which raises an exception if connection is dead
+    min_size: idle connections are never reaped below this number
+    max_size: maximal number of connections in use, 0 means no limit
+    idle_size: maximal number of idle connections kept for reuse
+    timeout: how many seconds get() waits for a free connection
+    max_age: connections older than that (in seconds) are closed
+    max_idle: idle connections unused for that long are closed
+    ping_after: connections idle for less than that are not pinged
+    """
+
+    def __init__(
+        self,
+        connect,
+        ping=None,
+        min_size=0,
+        max_size=0,
+        idle_size=0,
+        timeout=30,
+        max_age=0,
+        max_idle=0,
+        ping_after=30,
+        ):
+        # settings, to compare with other instances using this pool
+        self.conf = dict(min_size=min_size, max_size=max_size,
+                         idle_size=idle_size, timeout=timeout,
+                         max_age=max_age, max_idle=max_idle,
+                         ping_after=ping_after)
+        self._connect = connect
+        self._ping = ping
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_size = max(idle_size, min_size)
+        self.timeout = timeout
+        self.max_age = max_age
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self._condition = threading.Condition(threading.Lock())
+        self._idle = []  # [(connection, created, last_used)], newest last
+        self._created = {}  # id(connection) => created, for those in use
+        self.in_use = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.opened = 0
+        self.closed = 0
+        self.broken = 0
+        for i in xrange(min_size):
+            self._idle.append((self._open(), time.time(), time.time()))
+
+    def _open(self):
+        connection = self._connect()
+        self.opened += 1
+        return connection
+
+    def _close(self, connections):
+        for connection in connections:
+            self.closed += 1
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def _expired(self, now):
+        """
+        remove too old and (above min_size) too long idle connections,
+        must be called with lock held, returns them to be closed
+        """
+
+        expired = []
+        if self.max_age:
+            keep = [item for item in self._idle if item[1] + self.max_age > now]
+            if len(keep) != len(self._idle):
+                expired = [item[0] for item in self._idle if item[1] + self.max_age <= now]
+                self._idle = keep
+        if self.max_idle:
+            # oldest used are first
+            while len(self._idle) > self.min_size and \
+                    self._idle[0][2] + self.max_idle <= now:
+                expired.append(self._idle.pop(0)[0])
+        return expired
+
+    def get(self):
+        """
+        returns free connection, waits up to timeout seconds if max_size
+        connections are in use
+        """
+
+        start = time.time()
+        while True:
+            self._condition.acquire()
+            try:
+                waited = False
+                while True:
+                    expired = self._expired(time.time())
+                    if expired:
+                        self._condition.release()
+                        try:
+                            self._close(expired)
+                        finally:
+                            self._condition.acquire()
+                    if self._idle or not self.max_size \
+                            or self.in_use < self.max_size:
+                        break
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise SQLPoolTimeout, \
+                            'no free connection in %s seconds' % self.timeout
+                    if not waited:
+                        self.waits += 1
+                        waited = True
+                    self._condition.wait(remaining)
+                item = self._idle and self._idle.pop() or None
+                self.in_use += 1
+            finally:
+                self._condition.release()
+            if item is None:
+                try:
+                    connection = self._open()
+                except:
+                    self._discard(None)
+                    raise
+                self._created[id(connection)] = time.time()
+                return connection
+            (connection, created, used) = item
+            if self._ping and time.time() - used >= self.ping_after:
+                try:
+                    self._ping(connection)
+                except Exception:
+                    self.broken += 1
+                    self._discard(connection)
+                    continue
+            self._created[id(connection)] = created
+            return connection
+
+    def _discard(self, connection):
+        self._condition.acquire()
+        self.in_use -= 1
+        self._created.pop(id(connection), None)
+        self._condition.notify()
+        self._condition.release()
+        if connection is not None:
+            self._close([connection])
+
+    def put(self, connection, broken=False):
+        """
+        give connection back, broken ones are closed
+        """
+
+        if broken:
+            self.broken += 1
+            return self._discard(connection)
+        now = time.time()
+        self._condition.acquire()
+        try:
+            self.in_use -= 1
+            created = self._created.pop(id(connection), now)
+            if (not self.max_age or created + self.max_age > now) \
+                    and len(self._idle) < self.idle_size:
+                self._idle.append((connection, created, now))
+                connection = None
+            expired = self._expired(now)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        if connection is not None:
+            expired.append(connection)
+        self._close(expired)
+
+    def reap(self):
+        """
+        close expired idle connections now (it is done in get and put too)
+        """
+
+        self._condition.acquire()
+        try:
+            expired = self._expired(time.time())
+        finally:
+            self._condition.release()
+        self._close(expired)
+
+    def stats(self):
+        """
+        returns dict with number of connections in_use and idle and
+        counters of waits, timeouts, opened, closed and broken connections
+        """
+
+        return dict(
+            in_use=self.in_use,
+            idle=len(self._idle),
+            waits=self.waits,
+            timeouts=self.timeouts,
+            opened=self.opened,
+            closed=self.closed,
+            broken=self.broken,
+            )
+
+
 class SQLCallableList(list):
 
     def __call__(self):
@@ -557,6 +1035,10 @@ class SQLDB(SQLStorage):
     _connection_pools = {}
     _instances = {}
 
+    # ## number of compiled selects kept by every instance (see SQLSet.select)
+
+    _statement_cache_size = 1000
+
     @staticmethod
     def _set_thread_folder(folder):
         sql_locker.acquire()
@@ -569,31 +1051,27 @@ class SQLDB(SQLStorage):
     def close_all_instances(action):
         """ to close cleanly databases in a multithreaded environment """
 
-        sql_locker.acquire()
         pid = thread.get_ident()
+        sql_locker.acquire()
         if pid in SQLDB._folders:
             del SQLDB._folders[pid]
-        if pid in SQLDB._instances:
-            instances = SQLDB._instances[pid]
-            while instances:
-                instance = instances.pop()
-                sql_locker.release()
-                action(instance)
-                sql_locker.acquire()
-
-                # ## if you want pools recycle this connection
-                really = True
-                if instance._pool_size:
-                    pool = SQLDB._connection_pools[instance._uri]
-                    if len(pool) < instance._pool_size:
-                        pool.append(instance._connection)
-                        really = False
-                if really:
-                    sql_locker.release()
-                    instance._connection.close()
-                    sql_locker.acquire()
-            del SQLDB._instances[pid]
         sql_locker.release()
+        pool_locker.acquire()
+        instances = SQLDB._instances.pop(pid, [])
+        pool_locker.release()
+        error = None
+        while instances:
+            instance = instances.pop()
+
+            # ## if you want pools recycle this connection, failed action
+            # ## doesn't keep the other ones out of the pool
+
+            try:
+                instance._release(action)
+            except:
+                error = error or sys.exc_info()
+        if error:
+            raise error[0], error[1], error[2]
         return
 
     @staticmethod
@@ -622,26 +1100,120 @@ class SQLDB(SQLStorage):
 
     def _pool_connection(self, f):
 
-        # ## deal with particular case first:
+        # ## connections are made lazily, one for every thread which uses
+        # ## this database (see _acquire); instances with the same uri
+        # ## share the pool
+
+        self._connector = f
+        pool_locker.acquire()
+        try:
+            if not self._uri in self._connection_pools:
+                ping = SQL_DIALECTS.get(self._dbname, {}).get('ping', 'SELECT 1')
+                self._connection_pools[self._uri] = SQLConnectionPool(f,
+                        ping=lambda connection: connection.cursor().execute(ping),
+                        idle_size=self._pool_size, **self._pool_conf)
+            self._pool = self._connection_pools[self._uri]
+        finally:
+            pool_locker.release()
+        conf = dict(self._pool_conf, idle_size=self._pool_size)
+        if conf != self._pool.conf:
+            # uri isn't logged, it may contain password
+            logging.warning('%s pool already exists with other settings, '
+                            'they are kept: %s' % (self._dbname, self._pool.conf))
+
+    def _acquire(self):
+        """
+        get connection for current thread from the pool and register this
+        instance, so close_all_instances releases it
+        """
+
+        connection = self._pool.get()
+        self._local.connection = connection
+        self._local.cursor = connection.cursor()
+        self._register()
+
+    def _register(self):
+        """
+        register this instance for current thread, so close_all_instances
+        commits (or rolls back) and releases it
+        """
+
+        pid = thread.get_ident()
+        pool_locker.acquire()
+        try:
+            instances = self._instances.setdefault(pid, [])
+            for instance in instances:
+                if instance is self:
+                    return
+            instances.append(self)
+        finally:
+            pool_locker.release()
+
+    def _release(self, action=None):
+        """
+        call action (e.g. commit) and give connection of current thread
+        back to the pool
+        """
 
-        if not self._pool_size:
-            self._connection = f()
+        local = self._local
+        if local.connection is None:
             return
-        uri = self._uri
-        sql_locker.acquire()
-        if not uri in self._connection_pools:
-            self._connection_pools[uri] = []
-        if self._connection_pools[uri]:
-            self._connection = self._connection_pools[uri].pop()
-            sql_locker.release()
-        else:
-            sql_locker.release()
-            self._connection = f()
+        try:
+            if action:
+                action(self)
+        except:
+            if not isinstance(local, SQLShared):
+                connection = local.connection
+                local.connection = local.cursor = None
+                self._pool.put(connection, broken=True)
+            raise
+        if isinstance(local, SQLShared):
+            # single connection for all threads, e.g. sqlite:memory:
+            return
+        connection = local.connection
+        local.connection = local.cursor = None
+        self._pool.put(connection)
+
+    @property
+    def _connection(self):
+        local = self._local
+        if local.connection is None:
+            self._acquire()
+        elif isinstance(local, SQLShared):
+            # connection stays open, but every request has to commit it
+            self._register()
+        return local.connection
+
+    @property
+    def _cursor(self):
+        local = self._local
+        if local.connection is None:
+            self._acquire()
+        elif isinstance(local, SQLShared):
+            self._register()
+        return local.cursor
 
-    def __init__(self, uri='sqlite://dummy.db', pool_size=0, pools=0):
+    def __init__(
+        self,
+        uri='sqlite://dummy.db',
+        pool_size=0,
+        pools=0,
+        pool_min=0,
+        pool_max=0,
+        pool_timeout=30,
+        pool_max_age=0,
+        pool_max_idle=0,
+        pool_ping_after=30,
+        ):
         self._uri = str(uri)
         self._pool_size = pool_size or pools # for backward compatibility
+        self._pool_conf = dict(min_size=pool_min, max_size=pool_max,
+                               timeout=pool_timeout, max_age=pool_max_age,
+                               max_idle=pool_max_idle,
+                               ping_after=pool_ping_after)
         self['_lastsql'] = ''
+        self['_lastparams'] = ()
+        self['_statements'] = LRU(self._statement_cache_size)
         self.tables = SQLCallableList()
         pid = thread.get_ident()
 
@@ -661,29 +1233,39 @@ class SQLDB(SQLStorage):
 
         # Now connect to database
 
+        # every thread gets its own connection, except in-memory databases
+        # which exist only within one connection
+
+        self._local = SQLLocal()
+
         if self._uri[:14] == 'sqlite:memory:':
             self._dbname = 'sqlite'
-            self._pool_connection(lambda: \
-                    sqlite3.Connection(':memory:',
-                                       check_same_thread=False))
-            self._connection.create_function('web2py_extract', 2,
-                    sqlite3_web2py_extract)
-            self._cursor = self._connection.cursor()
+            self['_local'] = SQLShared()
+
+            def connect():
+                connection = sqlite3.Connection(':memory:',
+                        check_same_thread=False)
+                connection.create_function('web2py_extract', 2,
+                        sqlite3_web2py_extract)
+                return connection
+
+            self._pool_connection(connect)
             self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
         elif self._uri[:9] == 'sqlite://':
             self._dbname = 'sqlite'
             if uri[9] != '/':
                 dbpath = os.path.join(self._folder, uri[9:])
-                self._pool_connection(lambda : \
-                        sqlite3.Connection(dbpath,
-                                           check_same_thread=False))
             else:
-                self._pool_connection(lambda : \
-                        sqlite3.Connection(uri[9:],
-                                           check_same_thread=False))
-            self._connection.create_function('web2py_extract', 2,
-                                             sqlite3_web2py_extract)
-            self._cursor = self._connection.cursor()
+                dbpath = uri[9:]
+
+            def connect():
+                connection = sqlite3.Connection(dbpath,
+                        check_same_thread=False)
+                connection.create_function('web2py_extract', 2,
+                        sqlite3_web2py_extract)
+                return connection
+
+            self._pool_connection(connect)
             self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
         elif self._uri[:8] == 'mysql://':
             self._dbname = 'mysql'
@@ -709,18 +1291,23 @@ class SQLDB(SQLStorage):
             charset = m.group('charset')
             if not charset:
                 charset = 'utf8'
-            self._pool_connection(lambda : MySQLdb.Connection(
+
+            def connect():
+                connection = MySQLdb.Connection(
                     db=db,
                     user=user,
                     passwd=passwd,
                     host=host,
                     port=int(port),
                     charset=charset,
-                    ))
-            self._cursor = self._connection.cursor()
+                    )
+                cursor = connection.cursor()
+                cursor.execute('SET FOREIGN_KEY_CHECKS=0;')
+                cursor.execute("SET sql_mode='NO_BACKSLASH_ESCAPES';")
+                return connection
+
+            self._pool_connection(connect)
             self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
-            self._execute('SET FOREIGN_KEY_CHECKS=0;')
-            self._execute("SET sql_mode='NO_BACKSLASH_ESCAPES';")
         elif self._uri[:11] == 'postgres://':
             self._dbname = 'postgres'
             m = \
@@ -746,23 +1333,30 @@ class SQLDB(SQLStorage):
             msg = \
                 "dbname='%s' user='%s' host='%s' port=%s password='%s'"\
                  % (db, user, host, port, passwd)
-            self._pool_connection(lambda : psycopg2.connect(msg))
-            self._connection.set_client_encoding('UTF8')
-            self._cursor = self._connection.cursor()
+
+            def connect():
+                connection = psycopg2.connect(msg)
+                connection.set_client_encoding('UTF8')
+                cursor = connection.cursor()
+                cursor.execute('BEGIN;')
+                cursor.execute("SET CLIENT_ENCODING TO 'UNICODE';")  # ## not completely sure but should work
+                return connection
+
+            self._pool_connection(connect)
             self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
-            query = 'BEGIN;'
-            self['_lastsql'] = query
-            self._execute(query)
-            self._execute("SET CLIENT_ENCODING TO 'UNICODE';")  # ## not completely sure but should work
         elif self._uri[:9] == 'oracle://':
             self._dbname = 'oracle'
-            self._pool_connection(lambda : \
-                                  cx_Oracle.connect(self._uri[9:]))
-            self._cursor = self._connection.cursor()
-            self._execute = lambda a: \
-                oracle_fix_execute(a,self._cursor.execute)
-            self._execute("ALTER SESSION SET NLS_DATE_FORMAT = 'YYYY-MM-DD';")
-            self._execute("ALTER SESSION SET NLS_TIMESTAMP_FORMAT = 'YYYY-MM-DD HH24:MI:SS';")
+
+            def connect():
+                connection = cx_Oracle.connect(self._uri[9:])
+                cursor = connection.cursor()
+                oracle_fix_execute("ALTER SESSION SET NLS_DATE_FORMAT = 'YYYY-MM-DD';", cursor.execute)
+                oracle_fix_execute("ALTER SESSION SET NLS_TIMESTAMP_FORMAT = 'YYYY-MM-DD HH24:MI:SS';", cursor.execute)
+                return connection
+
+            self._pool_connection(connect)
+            self._execute = lambda a, *p: \
+                oracle_fix_execute(a, self._cursor.execute, *p)
         elif self._uri[:8] == 'mssql://' or self._uri[:9]\
              == 'mssql2://':
 
@@ -815,12 +1409,11 @@ class SQLDB(SQLStorage):
                     'Driver={SQL Server};server=%s;database=%s;uid=%s;pwd=%s'\
                      % (host, db, user, passwd)
             self._pool_connection(lambda : pyodbc.connect(cnxn))
-            self._cursor = self._connection.cursor()
             if self._uri[:8] == 'mssql://':
                 self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
             elif self._uri[:9] == 'mssql2://':
-                self._execute = lambda a: \
-                    self._cursor.execute(unicode(a, 'utf8'))
+                self._execute = lambda a, *p: \
+                    self._cursor.execute(unicode(a, 'utf8'), *p)
         elif self._uri[:11] == 'firebird://':
             self._dbname = 'firebird'
             m = \
@@ -846,14 +1439,16 @@ class SQLDB(SQLStorage):
             charset = m.group('charset')
             if not charset:
                 charset = 'UTF8'
-            self._pool_connection(lambda : \
-                                  kinterbasdb.connect(dsn='%s:%s'
-                                   % (host, db), user=user,
-                                  password=passwd))
-            self._cursor = self._connection.cursor()
+
+            def connect():
+                connection = kinterbasdb.connect(dsn='%s:%s' % (host, db),
+                        user=user, password=passwd)
+                if charset != 'None':
+                    connection.cursor().execute('SET NAMES %s;' % charset)
+                return connection
+
+            self._pool_connection(connect)
             self._execute = lambda *a, **b: self._cursor.execute(*a, **b)
-            if charset != 'None':
-                self._execute('SET NAMES %s;' % charset)
         elif self._uri[:11] == 'informix://':
             self._dbname = 'informix'
             m = \
@@ -879,13 +1474,11 @@ class SQLDB(SQLStorage):
             self._pool_connection(lambda : informixdb.connect('%s@%s'
                                    % (db, host), user=user,
                                   password=passwd))
-            self._cursor = self._connection.cursor()
-            self._execute = lambda a: self._cursor.execute(a[:-1])
+            self._execute = lambda a, *p: self._cursor.execute(a[:-1], *p)
         elif self._uri[:4] == 'db2:':
             self._dbname, cnxn = self._uri.split(':', 1)
             self._pool_connection(lambda : pyodbc.connect(cnxn))
-            self._cursor = self._connection.cursor()
-            self._execute = lambda a: self._cursor.execute(a[:-1])
+            self._execute = lambda a, *p: self._cursor.execute(a[:-1], *p)
         elif self._uri[:5] == 'jdbc:':
             self._dbname = self._uri.split(':')[1]
             if self._dbname == 'sqlite':
@@ -893,13 +1486,17 @@ class SQLDB(SQLStorage):
                     dbpath = os.path.join(self._folder, uri[14:])
                 else:
                     dbpath = os.path.join(self._folder, uri[14:])
-                self._pool_connection(lambda : zxJDBC.connect(uri[:14] + dbpath))
-                self._connection.create_function('web2py_extract', 2,
-                       sqlite3_web2py_extract)
+
+                def connect():
+                    connection = zxJDBC.connect(uri[:14] + dbpath)
+                    connection.create_function('web2py_extract', 2,
+                           sqlite3_web2py_extract)
+                    return connection
+
+                self._pool_connection(connect)
             else:
                 raise SyntaxError, "sorry only sqlite on jdbc for now"
-            self._cursor = self._connection.cursor()
-            self._execute = lambda a: self._cursor.execute(a[:-1])
+            self._execute = lambda a, *p: self._cursor.execute(a[:-1], *p)
         elif self._uri == 'None':
 
 
@@ -912,22 +1509,13 @@ class SQLDB(SQLStorage):
 
 
             self._dbname = 'sqlite'
-            self._connection = Dummy()
-            self._cursor = Dummy()
-            self._execute = lambda a: []
+            self['_local'] = SQLShared()
+            self._pool_connection(Dummy)
+            self._execute = lambda *a: []
         else:
             raise SyntaxError, 'database type not supported'
         self._translator = SQL_DIALECTS[self._dbname]
 
-        # ## register this instance of SQLDB
-
-        sql_locker.acquire()
-        if not pid in self._instances:
-            self._instances[pid] = []
-        self._instances[pid].append(self)
-        sql_locker.release()
-        pass
-
     def define_table(
         self,
         tablename,
@@ -946,6 +1534,7 @@ class SQLDB(SQLStorage):
         if tablename in self.tables:
             raise SyntaxError, 'table already defined'
         t = self[tablename] = SQLTable(self, tablename, *fields)
+        self._statements.clear()
         if self._uri == 'None':
             args['migrate'] = False
             return t
@@ -968,11 +1557,110 @@ class SQLDB(SQLStorage):
     def rollback(self):
         self._connection.rollback()
 
-    def executesql(self, query):
+    def _consecutive_ids(self):
+        """
+        True if ids of rows inserted by one statement are consecutive, i.e.
+        mysql auto_increment_increment is 1 and innodb_autoinc_lock_mode
+        isn't 2 (interleaved); checked once per instance
+        """
+
+        if self.get('_consecutive') is None:
+            self._execute('select @@auto_increment_increment, '
+                          '@@innodb_autoinc_lock_mode;')
+            (increment, lock_mode) = self._cursor.fetchone()
+            self['_consecutive'] = int(increment) == 1 and int(lock_mode) != 2
+        return self['_consecutive']
+
+    def executesql(self, query, params=None):
         self['_lastsql'] = query
-        self._execute(query)
+        if params:
+            self._execute(query, params)
+        else:
+            self._execute(query)
         return self._cursor.fetchall()
 
+    def _compile(self, parts):
+        """
+        returns (sql, params) for parts of statement, values are replaced by
+        placeholders of database driver
+        """
+
+        if not [part for part in parts if isinstance(part, SQLParam)]:
+            return (''.join(parts), ())
+        placeholder = self._translator['placeholder']
+        escape = placeholder == '%%s'
+        (sql, params) = ([], [])
+        for part in parts:
+            if isinstance(part, SQLParam):
+                params.append(sql_param(part.value, part.type,
+                              self._dbname))
+                mark = placeholder % dict(n=len(params))
+                template = sql_template(part.type, self._dbname)
+                if template:
+                    mark = template % mark
+                sql.append(mark)
+            elif escape:
+                sql.append(part.replace('%', '%%'))
+            else:
+                sql.append(part)
+        return (''.join(sql), params)
+
+    def _executemany(self, query, rows):
+        """
+        executes query (without trailing ;) for every row of parameters
+        """
+
+        self['_lastsql'] = query
+        self['_lastparams'] = rows
+        return self._cursor.executemany(query, rows)
+
+    def _execute_on(self, cursor, query, params=()):
+        """
+        executes query with dialect specific _execute, but on given cursor
+        (cursor of current thread is replaced meanwhile, shared connection
+        has cursor per thread)
+        """
+
+        self['_lastsql'] = query
+        self['_lastparams'] = params
+        local = self._local
+        self._cursor  # acquire connection
+        (previous, local.cursor) = (local.cursor, cursor)
+        try:
+            if params:
+                return self._execute(query, params)
+            return self._execute(query)
+        finally:
+            local.cursor = previous
+
+    def _stream_cursor(self, batch_size):
+        """
+        returns new cursor which doesn't fetch all rows at once, if
+        database supports that
+        """
+
+        if self._dbname == 'postgres':
+            cursor = self._connection.cursor('pygnite_%s' % uuid.uuid4().hex)
+            cursor.itersize = batch_size
+            return cursor
+        elif self._dbname == 'mysql':
+            import MySQLdb.cursors
+            return self._connection.cursor(MySQLdb.cursors.SSCursor)
+        cursor = self._connection.cursor()
+        try:
+            cursor.arraysize = batch_size
+        except AttributeError:
+            pass
+        return cursor
+
+    def _execute_statement(self, statement):
+        (query, params) = self._compile(statement.parts)
+        self['_lastsql'] = query
+        self['_lastparams'] = params
+        if params:
+            return self._execute(query, params)
+        return self._execute(query)
+
     def _update_referenced_by(self, other):
         for tablename in self.tables:
             by = self[tablename]._referenced_by
@@ -984,24 +1672,30 @@ class SQLDB(SQLStorage):
     def export_to_csv_file(self, ofile):
         for table in self.tables:
             ofile.write('TABLE %s\r\n' % table)
-            self(self[table].id > 0).select().export_to_csv_file(ofile)
+            self(self[table].id > 0).export_to_csv_file(ofile)
             ofile.write('''\r
 \r
 ''')
         ofile.write('END')
 
     def import_from_csv_file(self, ifile, id_map={}):
+        """
+        imports all tables exported by export_to_csv_file, returns dict of
+        statistics of every table (see SQLTable.import_from_csv_file)
+        """
+
+        stats = {}
         while True:
             line = ifile.readline()
             if line.strip() == 'END':
-                return
+                return stats
             if not line.strip():
                 continue
             if not line[:6] == 'TABLE ' or not line[6:].strip()\
                  in self.tables:
                 raise SyntaxError, 'invalid file format'
             table = line[6:].strip()
-            self[table].import_from_csv_file(ifile, id_map)
+            stats[table] = self[table].import_from_csv_file(ifile, id_map)
 
 
 def unpickle_SQLDB(state):
@@ -1052,6 +1746,10 @@ class SQLALL(object):
              self.table.fields]
         return ', '.join(s)
 
+    @property
+    def _tables(self):
+        return [self.table._tablename]
+
 
 class SQLJoin(object):
 
@@ -1062,6 +1760,10 @@ class SQLJoin(object):
     def __str__(self):
         return '%s ON %s' % (self.table, self.query)
 
+    @property
+    def parts(self):
+        return ['%s ON ' % self.table] + sql_parts(self.query)
+
 
 def is_integer(x):
     try:
@@ -1362,41 +2064,51 @@ class SQLTable(dict):
         self._db.commit()
         del self._db[self._tablename]
         del self._db.tables[self._db.tables.index(self._tablename)]
+        self._db._statements.clear()
         self._db._update_referenced_by(self._tablename)
         if self._dbt:
             os.unlink(self._dbt)
             logfile.write('success!\n')
 
-    def _insert(self, **fields):
-        (fs, vs) = ([], [])
+    def _insert_values(self, fields):
+        """
+        returns [(fieldname, value)] of new record: given fields and
+        defaults of others, raises SyntaxError if required field is missing
+        """
+
         if [key for key in fields if not key in self.fields]:
             raise SyntaxError, 'invalid field name'
+        items = []
         for fieldname in self.fields:
             if fieldname == 'id':
                 continue
             field = self[fieldname]
-            (ft, fd) = (field.type, field._db._dbname)
             if fieldname in fields:
-                fs.append(fieldname)
                 value = fields[fieldname]
                 try:
-                    vs.append(sql_represent(value.id, ft, fd))
-                except:
-                    vs.append(sql_represent(value, ft, fd))
+                    value = value.id
+                except (AttributeError, KeyError):
+                    pass
+                items.append((fieldname, value))
             elif field.default != None:
-                fs.append(fieldname)
-                vs.append(sql_represent(field.default, ft, fd))
+                items.append((fieldname, field.default))
             elif field.required is True:
                 raise SyntaxError,'SQLTable: missing required field: %s'%field 
+        return items
+
+    def _insert(self, **fields):
+        items = self._insert_values(fields)
+        fd = self._db._dbname
+        fs = [fieldname for (fieldname, value) in items]
+        vs = [sql_value(value, self[fieldname].type, fd) for (fieldname,
+              value) in items]
         sql_f = ', '.join(fs)
-        sql_v = ', '.join(vs)
         sql_t = self._tablename
-        return 'INSERT INTO %s(%s) VALUES (%s);' % (sql_t, sql_f, sql_v)
+        return SQLStatement(['INSERT INTO %s(%s) VALUES (' % (sql_t, sql_f)]
+                             + join_parts(vs, ', ') + [');'])
 
     def insert(self, **fields):
-        query = self._insert(**fields)
-        self._db['_lastsql'] = query
-        self._db._execute(query)
+        self._db._execute_statement(self._insert(**fields))
         if self._db._dbname == 'sqlite':
             id = self._db._cursor.lastrowid
         elif self._db._dbname == 'postgres':
@@ -1429,61 +2141,414 @@ class SQLTable(dict):
             id = None
         return id
 
+    def bulk_insert(self, items, ids=False):
+        """
+        inserts many records (list of dicts) at once. Rows are sent in
+        chunks as multi-row VALUES (or with executemany where database
+        doesn't support it); defaults and required fields are handled as
+        in insert.
+
+        returns list of new ids if ids is True, else number of inserted
+        records. Ids are cheap for sqlite, mysql (consecutive ids from
+        last_insert_id), postgres (RETURNING) and mssql (OUTPUT), other
+        databases insert records one by one to get them. So does mysql with
+        auto_increment_increment other than 1 or innodb_autoinc_lock_mode 2,
+        where ids of one statement may have gaps.
+        """
+
+        translator = self._db._translator
+        (max_rows, max_params) = (translator['insert_rows'],
+                                  translator['max_params'])
+        (result, chunk, key) = ([], [], None)
+        for fields in items:
+            values = self._insert_values(fields)
+            fs = tuple([fieldname for (fieldname, value) in values])
+            size = max_rows and max(1, min(max_rows, max_params
+                                            / max(1, len(fs)))) or 1000
+            if chunk and (fs != key or len(chunk) >= size):
+                result += self._bulk_insert(key, chunk, ids)
+                chunk = []
+            key = fs
+            chunk.append([value for (fieldname, value) in values])
+        if chunk:
+            result += self._bulk_insert(key, chunk, ids)
+        if ids:
+            return result
+        return sum(result)
+
+    def _bulk_insert(self, fs, rows, ids):
+        """
+        inserts rows (lists of values of fields fs), returns list of ids or
+        [number of rows]
+        """
+
+        db = self._db
+        (dbname, translator) = (db._dbname, db._translator)
+        types = [self[fieldname].type for fieldname in fs]
+        if not fs or [ft for ft in types if isinstance(ft, SQLCustomType)]\
+             or [value for row in rows for value in row
+                 if isinstance(value, SQLXorable)]:
+            # values which have to be inlined in SQL
+            new_ids = [self.insert(**dict(zip(fs, row))) for row in rows]
+            return ids and new_ids or [len(rows)]
+        params = [[sql_param(value, ft, dbname) for (value, ft) in
+                  zip(row, types)] for row in rows]
+        values = lambda offset: '(%s)' % ', '.join(self._marks(types,
+                offset))
+        sql = 'INSERT INTO %s(%s)' % (self._tablename, ', '.join(fs))
+        multirow = translator['insert_rows'] and (dbname != 'sqlite'
+                 or sqlite3.sqlite_version_info >= (3, 7, 11))
+        if ids and (not (multirow and dbname in ['sqlite', 'mysql',
+                    'postgres', 'mssql', 'mssql2']) or dbname == 'mysql'
+                    and not db._consecutive_ids()):
+            # no way to get ids of all rows at once
+            return [self.insert(**dict(zip(fs, row))) for row in rows]
+        if not multirow or dbname == 'sqlite' and not ids:
+            db._executemany('%s VALUES %s' % (sql, values(0)), params)
+            return [len(rows)]
+        n = len(types)
+        if ids and dbname in ['mssql', 'mssql2']:
+            sql += ' OUTPUT INSERTED.id'
+        sql += ' VALUES ' + ', '.join([values(i * n) for i in
+                                      xrange(len(rows))])
+        if ids and dbname == 'postgres':
+            sql += ' RETURNING id'
+        db['_lastsql'] = sql + ';'
+        db['_lastparams'] = params = [value for row in params
+                                      for value in row]
+        db._execute(sql + ';', params)
+        if not ids:
+            return [len(rows)]
+        if dbname == 'sqlite':
+            last = db._cursor.lastrowid
+            return range(last - len(rows) + 1, last + 1)
+        elif dbname == 'mysql':
+            # id of first row, others are consecutive
+            db._execute('select last_insert_id();')
+            first = int(db._cursor.fetchone()[0])
+            return range(first, first + len(rows))
+        else:
+            return [int(row[0]) for row in db._cursor.fetchall()]
+
+    def _marks(self, types, offset=0):
+        """
+        returns placeholders for values of given field types, numbered
+        from offset (for numeric placeholders)
+        """
+
+        (dbname, placeholder) = (self._db._dbname,
+                                 self._db._translator['placeholder'])
+        marks = []
+        for (i, ft) in enumerate(types):
+            mark = placeholder % dict(n=offset + i + 1)
+            template = sql_template(ft, dbname)
+            marks.append(template and template % mark or mark)
+        return marks
+
+    def upsert(self, keys, **fields):
+        """
+        inserts record or updates fields of record with the same values of
+        keys (list of field names), e.g.
+
+        db.users.upsert(keys=['email'], email='me@example.com', name='me')
+
+        keys have to be unique in database (unique=True fields or unique
+        index). It's one statement: INSERT ... ON CONFLICT (postgres,
+        sqlite), INSERT ... ON DUPLICATE KEY UPDATE (mysql) or MERGE
+        (oracle, mssql); elsewhere record is updated and inserted if there
+        was nothing to update, in current transaction. id can't be a key
+        (ids are assigned by database, use update for that). returns 1,
+        number of records like bulk_upsert; it doesn't tell if record was
+        inserted or updated.
+        """
+
+        return self.bulk_upsert([fields], keys)
+
+    def bulk_upsert(self, items, keys):
+        """
+        upsert of many records (list of dicts), they are sent in chunks
+        like in bulk_insert. returns number of records (inserted and
+        updated together)
+        """
+
+        if isinstance(keys, str):
+            keys = [keys]
+        if [key for key in keys if not key in self.fields]:
+            raise SyntaxError, 'invalid field name'
+        if 'id' in keys:
+            raise ValueError, 'upsert: id is assigned by database, it can\'t be a key'
+        (db, translator) = (self._db, self._db._translator)
+        dbname = db._dbname
+        native = dbname in ['postgres', 'mysql', 'oracle', 'mssql', 'mssql2']\
+             or dbname == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24, 0)
+        defaults = [(fieldname, self[fieldname].update) for fieldname in
+                    self.fields if fieldname != 'id' and
+                    self[fieldname].update != None]
+        (chunk, group, seen, count) = ([], None, set(), 0)
+        for fields in items:
+            if [key for key in keys if not key in fields]:
+                raise SyntaxError, 'upsert: missing key field'
+            values = self._insert_values(fields)
+            fs = tuple([fieldname for (fieldname, value) in values])
+            us = tuple([fieldname for fieldname in self.fields
+                       if fieldname in fields and not fieldname in keys])
+            if not native or [value for (fieldname, value) in values
+                              if isinstance(value, SQLXorable)] or \
+                [fieldname for fieldname in fs
+                 if isinstance(self[fieldname].type, SQLCustomType)]:
+                self._upsert(keys, fields)
+                count += 1
+                continue
+            size = max(1, min(translator['insert_rows'] or 1,
+                       (translator['max_params'] - len(defaults))
+                       / max(1, len(fs))))
+            key = tuple([fields[k] for k in keys])
+            if chunk and ((fs, us) != group or len(chunk) >= size
+                          or key in seen):
+                # same key twice in one statement isn't allowed everywhere
+                count += self._bulk_upsert(keys, group, chunk, defaults)
+                (chunk, seen) = ([], set())
+            group = (fs, us)
+            seen.add(key)
+            chunk.append([value for (fieldname, value) in values])
+        if chunk:
+            count += self._bulk_upsert(keys, group, chunk, defaults)
+        return count
+
+    def _upsert(self, keys, fields):
+        """
+        upsert without native support: update, insert if nothing was updated
+        """
+
+        query = self[keys[0]] == fields[keys[0]]
+        for key in keys[1:]:
+            query = query & (self[key] == fields[key])
+        others = dict([(k, v) for (k, v) in fields.items() if not k in keys])
+        if others:
+            if self._db(query).update(**others):
+                return
+        elif self._db(query).count():
+            return
+        self.insert(**fields)
+
+    def _bulk_upsert(self, keys, (fs, us), rows, defaults):
+        db = self._db
+        dbname = db._dbname
+        t = self._tablename
+        if not us:
+            # only keys given, existing record stays as it is
+            defaults = []
+        # values given by caller win over update defaults, like in update
+        defaults = [(fieldname, value) for (fieldname, value) in defaults
+                    if not fieldname in us and not fieldname in keys]
+        types = [self[fieldname].type for fieldname in fs]
+        params = [[sql_param(value, ft, dbname) for (value, ft) in
+                  zip(row, types)] for row in rows]
+        dtypes = [self[fieldname].type for (fieldname, value) in defaults]
+        dparams = [sql_param(value, self[fieldname].type, dbname)
+                   for (fieldname, value) in defaults]
+        if dbname in ['oracle', 'mssql', 'mssql2']:
+            # MERGE of one record, executed for every record
+            marks = self._marks(types)
+            dmarks = self._marks(dtypes, len(fs))
+            if dbname == 'oracle':
+                source = '(SELECT %s FROM DUAL) s' % ', '.join(['%s %s'
+                        % (mark, fieldname) for (mark, fieldname) in
+                        zip(marks, fs)])
+            else:
+                source = '(VALUES (%s)) AS s(%s)' % (', '.join(marks),
+                        ', '.join(fs))
+            sets = ['%s=s.%s' % (f, f) for f in us] + ['%s=%s' % (f, mark)
+                    for ((f, value), mark) in zip(defaults, dmarks)]
+            sql = 'MERGE INTO %s USING %s ON (%s)' % (t, source,
+                    ' AND '.join(['%s.%s=s.%s' % (t, k, k) for k in keys]))
+            if sets:
+                sql += ' WHEN MATCHED THEN UPDATE SET ' + ', '.join(sets)
+            sql += ' WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s)'\
+                 % (', '.join(fs), ', '.join(['s.%s' % f for f in fs]))
+            if dbname != 'oracle':
+                sql += ';'
+            db._executemany(sql, [row + dparams for row in params])
+            return len(rows)
+        n = len(fs)
+        sql = 'INSERT INTO %s(%s) VALUES %s' % (t, ', '.join(fs),
+                ', '.join(['(%s)' % ', '.join(self._marks(types, i * n))
+                for i in xrange(len(rows))]))
+        dmarks = self._marks(dtypes, n * len(rows))
+        if dbname == 'mysql':
+            sets = ['%s=VALUES(%s)' % (f, f) for f in us]
+            sets += ['%s=%s' % (f, mark) for ((f, value), mark) in
+                     zip(defaults, dmarks)]
+            sql += ' ON DUPLICATE KEY UPDATE %s' % (', '.join(sets)
+                    or 'id=id')
+        else:
+            sets = ['%s=excluded.%s' % (f, f) for f in us]
+            sets += ['%s=%s' % (f, mark) for ((f, value), mark) in
+                     zip(defaults, dmarks)]
+            sql += ' ON CONFLICT (%s) DO %s' % (', '.join(keys), sets
+                    and 'UPDATE SET ' + ', '.join(sets) or 'NOTHING')
+        params = [value for row in params for value in row]
+        if sets:
+            params += dparams
+        db['_lastsql'] = sql + ';'
+        db['_lastparams'] = params
+        db._execute(sql + ';', params)
+        return len(rows)
+
     def import_from_csv_file(
         self,
         csvfile,
         id_map=None,
         null='<NULL>',
         unique='uuid',
+        chunk_size=500,
+        commit_every=None,
         ):
         """
         import records from csv file. Column headers must have same names as
         table fields. field 'id' is ignored. If column names read 'table.file'
         the 'table.' prefix is ignored.
         'unique' argument is a field which must be unique (typically a uuid field)
+
+        records are inserted in chunks of chunk_size (with COPY on postgres),
+        records whose unique value is already in table are updated instead
+        (with bulk_upsert if field is defined unique=True and id_map isn't
+        needed); commit_every commits after that many records.
+        returns dict with number of rows, inserted, updated and upserted
+        records, seconds and rows_per_second
         """
 
+        start = time.time()
         reader = csv.reader(csvfile)
-        colnames = None
+        id_map_self = None
         if isinstance(id_map, dict):
             if not self._tablename in id_map:
                 id_map[self._tablename] = {}
             id_map_self = id_map[self._tablename]
+        stats = dict(rows=0, inserted=0, updated=0, upserted=0)
 
-        def fix(field, value, id_map):
-            if value == null:
-                value = None
-            elif id_map and field.type[:9] == 'reference':
-                try:
-                    value = id_map[field.type[9:].strip()][value]
-                except KeyError:
-                    pass
-            return (field.name, value)
+        def converter(field):
+            referee = field.type[:9] == 'reference' and field.type[9:].strip()
 
+            def convert(value):
+                if value == null:
+                    return None
+                elif id_map and referee:
+                    return id_map.get(referee, {}).get(value, value)
+                return value
+
+            return convert
+
+        def normalize(value):
+            if isinstance(value, unicode):
+                return value
+            return str(value).decode('utf-8')
+
+        def flush(lines):
+            records = [dict([(name, convert(line[i])) for (i, name,
+                       convert) in converters]) for line in lines]
+            # (True, id) of updated or (False, i) of i-th new record
+            targets = [(False, i) for i in xrange(len(records))]
+            if ukey is not None and cid is None and self[unique].unique:
+                # database knows field is unique, let it find duplicates
+                stats['upserted'] += self.bulk_upsert(records, [unique])
+                stats['rows'] += len(lines)
+                return
+            if ukey is not None:
+                # one query for duplicates in the whole chunk
+                values = set([record[unique] for record in records])
+                field = self[unique]
+                existing = dict([(normalize(row[unique]), row.id)
+                                for row in self._db(field.belongs(values
+                                )).select(self.id, field)])
+                (new, pending, targets) = ([], {}, [])
+                for record in records:
+                    key = normalize(record[unique])
+                    if key in existing:
+                        self._db(self.id == existing[key]).update(**record)
+                        stats['updated'] += 1
+                        targets.append((True, existing[key]))
+                    elif key in pending:
+                        # repeated in this chunk, last values win
+                        new[pending[key]].update(record)
+                        targets.append((False, pending[key]))
+                    else:
+                        pending[key] = len(new)
+                        targets.append((False, len(new)))
+                        new.append(record)
+                records = new
+            if cid is not None:
+                new_ids = self.bulk_insert(records, ids=True)
+                for (line, (updated, target)) in zip(lines, targets):
+                    if not updated:
+                        target = new_ids[target]
+                    id_map_self[line[cid]] = target
+            elif records and self._db._dbname == 'postgres' and not \
+                    [f for f in self.fields if isinstance(self[f].type,
+                     SQLCustomType)]:
+                self._copy_from(records)
+            else:
+                self.bulk_insert(records)
+            stats['inserted'] += len(records)
+            stats['rows'] += len(lines)
+
+        (colnames, chunk, uncommitted) = (None, [], 0)
         for line in reader:
             if not line:
                 break
             if not colnames:
                 colnames = [x[x.find('.') + 1:] for x in line]
-                c = [i for i in xrange(len(line)) if colnames[i] != 'id']
-                cid = [i for i in xrange(len(line)) if colnames[i] == 'id']
-                if cid:
-                    cid = cid[0]
-            else:
-                items = [fix(self[colnames[i]], line[i], id_map) for i in c]
-                if not unique or unique not in colnames:
-                    new_id = self.insert(**dict(items))
-                else:
-                    # Validation. Check for duplicate of 'unique' &, if present, update instead of insert.
-                    for i in c:
-                        if colnames[i] == unique:
-                            _unique = line[i]
-                    if self._db(self._db[self][unique]==_unique).count():
-                        self._db(self[unique]==_unique).update(**dict(items))
-                    else:
-                        new_id = self.insert(**dict(items))
-                if id_map and cid != []:
-                    id_map_self[line[cid]] = new_id
+                converters = [(i, name, converter(self[name])) for (i,
+                              name) in enumerate(colnames) if name != 'id']
+                cid = None
+                if id_map_self is not None and 'id' in colnames:
+                    cid = colnames.index('id')
+                ukey = None
+                if unique and unique in colnames:
+                    ukey = colnames.index(unique)
+                continue
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                (uncommitted, chunk) = (uncommitted + len(chunk), [])
+                if commit_every and uncommitted >= commit_every:
+                    self._db.commit()
+                    uncommitted = 0
+        if chunk:
+            flush(chunk)
+        stats['seconds'] = seconds = time.time() - start
+        stats['rows_per_second'] = seconds and stats['rows'] / seconds or 0.0
+        logging.info('imported %(rows)s rows into %(table)s in %(seconds).2fs (%(rows_per_second).0f rows/s)'
+                      % dict(stats, table=self._tablename))
+        return stats
+
+    def _copy_from(self, items):
+        """
+        inserts records (list of dicts) with postgres COPY
+        """
+
+        rows = [self._insert_values(fields) for fields in items]
+        fs = [fieldname for (fieldname, value) in rows[0]]
+        types = [self[fieldname].type for fieldname in fs]
+
+        def escape(value):
+            if value is None:
+                return '\\N'
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            return str(value).replace('\\', '\\\\').replace('\t', '\\t'
+                    ).replace('\n', '\\n').replace('\r', '\\r')
+
+        data = cStringIO.StringIO()
+        for values in rows:
+            data.write('\t'.join([escape(sql_param(value, ft, 'postgres'))
+                       for ((fieldname, value), ft) in zip(values, types)])
+                       + '\n')
+        data.seek(0)
+        self._db['_lastsql'] = 'COPY %s(%s) FROM STDIN;' % (self._tablename,
+                ', '.join(fs))
+        self._db._cursor.copy_from(data, self._tablename, columns=fs,
+                                   null='\\N')
 
     def on(self, query):
         return SQLJoin(self, query)
@@ -1516,17 +2581,20 @@ class SQLXorable(object):
         name,
         type='string',
         db=None,
+        tables=None,
         ):
         (self.name, self.type, self._db) = (name, type, db)
+        self._tables = tables  # None means find them in name
 
     def __str__(self):
         return self.name
 
     def __or__(self, other):  # for use in sortby
-        return SQLXorable(str(self) + ', ' + str(other), None, None)
+        return SQLXorable(str(self) + ', ' + str(other), None, None,
+                          merge_tables(sql_tables(self), sql_tables(other)))
 
     def __invert__(self):
-        return SQLXorable(str(self) + ' DESC', None, None)
+        return SQLXorable(str(self) + ' DESC', None, None, sql_tables(self))
 
     # for use in SQLQuery
 
@@ -1559,22 +2627,27 @@ class SQLXorable(object):
     def __add__(self, other):
         return SQLXorable('(%s+%s)' % (self, sql_represent(other,
                           self.type, self._db._dbname)), self.type,
-                          self._db)
+                          self._db, self._tables_with(other))
 
     def __sub__(self, other):
         return SQLXorable('(%s-%s)' % (self, sql_represent(other,
                           self.type, self._db._dbname)), self.type,
-                          self._db)
+                          self._db, self._tables_with(other))
 
     def __mul__(self, other):
         return SQLXorable('(%s*%s)' % (self, sql_represent(other,
                           self.type, self._db._dbname)), self.type,
-                          self._db)
+                          self._db, self._tables_with(other))
 
     def __div__(self, other):
         return SQLXorable('(%s/%s)' % (self, sql_represent(other,
                           self.type, self._db._dbname)), self.type,
-                          self._db)
+                          self._db, self._tables_with(other))
+
+    def _tables_with(self, other):
+        if isinstance(other, SQLXorable):
+            return merge_tables(sql_tables(self), sql_tables(other))
+        return sql_tables(self)
 
 
 class SQLCustomType:
@@ -1699,64 +2772,81 @@ class SQLField(SQLXorable):
 
     def lower(self):
         s = self._db._translator['lower'] % dict(field=str(self))
-        return SQLXorable(s, 'string', self._db)
+        return SQLXorable(s, 'string', self._db,
+                          [self._tablename])
 
     def upper(self):
         s = self._db._translator['upper'] % dict(field=str(self))
-        return SQLXorable(s, 'string', self._db)
+        return SQLXorable(s, 'string', self._db,
+                          [self._tablename])
 
     def year(self):
         s = self._db._translator['extract'] % dict(name='year',
                 field=str(self))
-        return SQLXorable(s, 'integer', self._db)
+        return SQLXorable(s, 'integer', self._db,
+                          [self._tablename])
 
     def month(self):
         s = self._db._translator['extract'] % dict(name='month',
                 field=str(self))
-        return SQLXorable(s, 'integer', self._db)
+        return SQLXorable(s, 'integer', self._db,
+                          [self._tablename])
 
     def day(self):
         s = self._db._translator['extract'] % dict(name='day',
                 field=str(self))
-        return SQLXorable(s, 'integer', self._db)
+        return SQLXorable(s, 'integer', self._db,
+                          [self._tablename])
 
     def hour(self):
         s = self._db._translator['extract'] % dict(name='hour',
                 field=str(self))
-        return SQLXorable(s, 'integer', self._db)
+        return SQLXorable(s, 'integer', self._db,
+                          [self._tablename])
 
     def minutes(self):
         s = self._db._translator['extract'] % dict(name='minute',
                 field=str(self))
-        return SQLXorable(s, 'integer', self._db)
+        return SQLXorable(s, 'integer', self._db,
+                          [self._tablename])
 
     def seconds(self):
         s = self._db._translator['extract'] % dict(name='second',
                 field=str(self))
-        return SQLXorable(s, 'integer', self._db)
+        return SQLXorable(s, 'integer', self._db,
+                          [self._tablename])
 
     def count(self):
-        return SQLXorable('COUNT(%s)' % str(self), 'integer', self._db)
+        return SQLXorable('COUNT(%s)' % str(self), 'integer', self._db,
+                          [self._tablename])
 
     def sum(self):
-        return SQLXorable('SUM(%s)' % str(self), 'integer', self._db)
+        return SQLXorable('SUM(%s)' % str(self), 'integer', self._db,
+                          [self._tablename])
 
     def max(self):
-        return SQLXorable('MAX(%s)' % str(self), 'integer', self._db)
+        return SQLXorable('MAX(%s)' % str(self), 'integer', self._db,
+                          [self._tablename])
 
     def min(self):
-        return SQLXorable('MIN(%s)' % str(self), 'integer', self._db)
+        return SQLXorable('MIN(%s)' % str(self), 'integer', self._db,
+                          [self._tablename])
 
     def __getslice__(self, start, stop):
         if start < 0 or stop < start:
             raise SyntaxError, 'not supported'
         d = dict(field=str(self), pos=start + 1, length=stop - start)
         s = self._db._translator['substring'] % d
-        return SQLXorable(s, 'string', self._db)
+        return SQLXorable(s, 'string', self._db,
+                          [self._tablename])
 
     def __str__(self):
         return '%s.%s' % (self._tablename, self.name)
 
+    @property
+    def _tables(self):
+        return [self._tablename]
+
 
 SQLDB.Field = SQLField  # necessary in gluon/globals.py session.connect
 SQLDB.Table = SQLTable  # necessary in gluon/globals.py session.connect
@@ -1780,43 +2870,123 @@ class SQLQuery(object):
         op=None,
         right=None,
         ):
+
+        # ## query is a tree: raw SQL (op is None), AND/OR/NOT of other
+        # ## queries or comparison of field with value; its SQL (parts) and
+        # ## shape are computed once, when they are needed
+
+        (self.left, self.op, self.right) = (left, op, right)
+        (self._parts, self._key) = (None, None)
         if op is None and right is None:
-            self.sql = left
+            self._tablenames = None
+        elif op in ('AND', 'OR'):
+            self._tablenames = merge_tables(left._tables, right._tables)
+        elif op == 'NOT':
+            self._tablenames = left._tables
         elif right is None:
-            if op == '=':
-                self.sql = '%s %s' % (left,
-                        left._db._translator['is null'])
-            elif op == '<>':
-                self.sql = '%s %s' % (left,
-                        left._db._translator['is not null'])
-            else:
+            if not op in ('=', '<>'):
                 raise SyntaxError, 'do not know what to do'
+            self._tablenames = sql_tables(left)
         elif op == ' IN ':
-            if isinstance(right, str):
-                self.sql = '%s%s(%s)' % (left, op, right[:-1])
-            elif hasattr(right, '__iter__'):
-                r = ','.join([sql_represent(i, left.type, left._db)
-                             for i in right])
-                self.sql = '%s%s(%s)' % (left, op, r)
-            else:
+            if not isinstance(right, (str, SQLStatement))\
+                 and not hasattr(right, '__iter__'):
                 raise SyntaxError, 'do not know what to do'
+            # tables of nested select are not tables of this query
+            self._tablenames = sql_tables(left)
+        elif isinstance(right, (SQLField, SQLXorable)):
+            self._tablenames = merge_tables(sql_tables(left),
+                    sql_tables(right))
+        else:
+            self._tablenames = sql_tables(left)
+
+    @property
+    def _tables(self):
+        if self._tablenames is None:
+            self._tablenames = parse_tablenames(self._text())
+        return self._tablenames
+
+    @property
+    def parts(self):
+        if self._parts is None:
+            self._parts = self._render()
+        return self._parts
+
+    def _render(self):
+        (left, op, right) = (self.left, self.op, self.right)
+        if op is None and right is None:
+            return sql_parts(left)
+        elif op in ('AND', 'OR'):
+            return ['('] + left.parts + [' %s ' % op] + right.parts + [')']
+        elif op == 'NOT':
+            return ['(NOT '] + left.parts + [')']
+        elif right is None:
+            if op == '=':
+                return ['%s %s' % (left, left._db._translator['is null'])]
+            else:
+                return ['%s %s' % (left, left._db._translator['is not null'])]
+        elif op == ' IN ':
+            if isinstance(right, (str, SQLStatement)):
+                # nested select without trailing ;
+                parts = sql_parts(right)
+                parts[-1] = parts[-1][:-1]
+                return ['%s%s(' % (left, op)] + parts + [')']
+            r = [sql_value(i, left.type, left._db._dbname) for i in right]
+            return ['%s%s(' % (left, op)] + join_parts(r, ',') + [')']
         elif isinstance(right, (SQLField, SQLXorable)):
-            self.sql = '%s%s%s' % (left, op, right)
+            return ['%s%s%s' % (left, op, right)]
         else:
-            right = sql_represent(right, left.type, left._db._dbname)
-            self.sql = '%s%s%s' % (left, op, right)
+            right = sql_value(right, left.type, left._db._dbname)
+            return ['%s%s' % (left, op), right]
+
+    def _shape(self):
+        """
+        returns (shape, params): hashable SQL of query without values and
+        list of its values, see sql_shape
+        """
+
+        if self._key is None:
+            (left, op) = (self.left, self.op)
+            if op in ('AND', 'OR'):
+                (a, pa) = left._shape()
+                (b, pb) = self.right._shape()
+                self._key = ((op, a, b), pa + pb)
+            elif op == 'NOT':
+                (a, pa) = left._shape()
+                self._key = ((op, a), pa)
+            else:
+                params = []
+                self._key = (sql_shape(self.parts, params), params)
+        return self._key
 
     def __and__(self, other):
-        return SQLQuery('(%s AND %s)' % (self, other))
+        return SQLQuery(self, 'AND', sql_query(other))
 
     def __or__(self, other):
-        return SQLQuery('(%s OR %s)' % (self, other))
+        return SQLQuery(self, 'OR', sql_query(other))
 
     def __invert__(self):
-        return SQLQuery('(NOT %s)' % self)
+        return SQLQuery(self, 'NOT')
 
     def __str__(self):
-        return self.sql
+        return ''.join([str(part) for part in self.parts])
+
+    @property
+    def sql(self):
+        return str(self)
+
+    def _text(self):
+        """
+        SQL without values, enough to find out which tables are used
+        """
+
+        return ''.join([part for part in self.parts if not isinstance(part,
+                       SQLParam)])
+
+
+def sql_query(obj):
+    if isinstance(obj, SQLQuery):
+        return obj
+    return SQLQuery(obj)
 
 
 regex_tables = re.compile('(?P<table>[a-zA-Z]\w*)\.')
@@ -1873,24 +3043,30 @@ class SQLSet(object):
 
     def __init__(self, db, where=''):
         self._db = db
-        self._tables = []
-
-        # find out wchich tables are involved
+        if where and not isinstance(where, SQLQuery):
+            where = SQLQuery(str(where))
+        self._where = where or None
 
-        self.sql_w = str(where or '')
+    @property
+    def _tables(self):
 
-        # print self.sql_w
+        # tables involved are known by query
 
-        self._tables = parse_tablenames(self.sql_w)
-
-        # print self._tables
+        if self._where:
+            return self._where._tables
+        return []
 
     def __call__(self, where):
-        if self.sql_w:
-            return SQLSet(self._db, SQLQuery(self.sql_w) & where)
+        if self._where:
+            return SQLSet(self._db, self._where & where)
         else:
             return SQLSet(self._db, where)
 
+    def _where_parts(self):
+        if self._where:
+            return [' WHERE '] + self._where.parts
+        return []
+
     def _select(self, *fields, **attributes):
         valid_attributes = [
             'orderby',
@@ -1913,15 +3089,13 @@ class SQLSet(object):
         if not fields:
             fields = [self._db[table].ALL for table in self._tables]
         sql_f = ', '.join([str(f) for f in fields])
-        tablenames = parse_tablenames(self.sql_w + ' ' + sql_f)
+        tablenames = merge_tables(self._tables, *[sql_tables(f) for f in
+                                  fields])
         if len(tablenames) < 1:
             raise SyntaxError, 'SQLSet: no tables selected'
         self.colnames = [c.strip() for c in sql_f.split(', ')]
-        if self.sql_w:
-            sql_w = ' WHERE ' + self.sql_w
-        else:
-            sql_w = ''
-        sql_o = ''
+        sql_w = self._where_parts()
+        sql_o = ['']
         sql_s = 'SELECT'
         if attributes.get('distinct', False):
             sql_s += ' DISTINCT'
@@ -1936,82 +3110,248 @@ class SQLSet(object):
             joinont = [t.table._tablename for t in joinon]
             excluded = [t for t in tablenames if not t in joint
                          + joinont]
-            sql_t = ', '.join(excluded)
+            sql_t = [', '.join(excluded)]
             if joint:
-                sql_t += ' %s %s' % (command, ', '.join(joint))
+                sql_t[-1] += ' %s %s' % (command, ', '.join(joint))
             for t in joinon:
-                sql_t += ' %s %s' % (command, str(t))
+                sql_t += [' %s ' % command] + t.parts
         else:
-            sql_t = ', '.join(tablenames)
+            sql_t = [', '.join(tablenames)]
         if attributes.get('groupby', False):
-            sql_o += ' GROUP BY %s' % attributes['groupby']
+            sql_o[-1] += ' GROUP BY %s' % attributes['groupby']
             if attributes.get('having', False):
-                sql_o += ' HAVING %s' % attributes['having']
+                sql_o += [' HAVING '] + sql_parts(attributes['having']) + ['']
         orderby = attributes.get('orderby', False)
         if orderby:
             if isinstance(orderby, (list, tuple)):
                 orderby = xorify(orderby)
             if str(orderby) == '<random>':
-                sql_o += ' ORDER BY %s' % self._db._translator['random']
+                sql_o[-1] += ' ORDER BY %s' % self._db._translator['random']
             else:
-                sql_o += ' ORDER BY %s' % orderby
+                sql_o[-1] += ' ORDER BY %s' % orderby
         if attributes.get('limitby', False):
             # oracle does not support limitby
             (lmin, lmax) = attributes['limitby']
             if self._db._dbname in ['oracle']:
                 if not attributes.get('orderby', None):
-                    sql_o += ' ORDER BY %s' % ', '.join([t + '.id'
+                    sql_o[-1] += ' ORDER BY %s' % ', '.join([t + '.id'
                             for t in tablenames])
                 if len(sql_w) > 1:
-                    sql_w_row = sql_w + ' AND w_row > %i' % lmin
+                    sql_w_row = sql_w + [' AND w_row > %i' % lmin]
                 else:
-                    sql_w_row = 'WHERE w_row > %i' % lmin
-                return '%s %s FROM (SELECT w_tmp.*, ROWNUM w_row FROM (SELECT %s FROM %s%s%s) w_tmp WHERE ROWNUM<=%i) %s %s;' % (sql_s, sql_f, sql_f, sql_t, sql_w, sql_o, lmax, sql_t, sql_w_row)
+                    sql_w_row = ['WHERE w_row > %i' % lmin]
+                return SQLStatement(['%s %s FROM (SELECT w_tmp.*, ROWNUM w_row FROM (SELECT %s FROM ' % (sql_s, sql_f, sql_f)]
+                                    + sql_t + sql_w + sql_o
+                                    + [') w_tmp WHERE ROWNUM<=%i) ' % lmax]
+                                    + sql_t + [' '] + sql_w_row + [';'])
                 #return '%s %s FROM (SELECT w_tmp.*, ROWNUM w_row FROM (SELECT %s FROM %s%s%s) w_tmp WHERE ROWNUM<=%i) %s WHERE w_row>%i;' % (sql_s, sql_f, sql_f, sql_t, sql_w, sql_o, lmax, sql_t, lmin)
                 #return '%s %s FROM (SELECT *, ROWNUM w_row FROM (SELECT %s FROM %s%s%s) WHERE ROWNUM<=%i) WHERE w_row>%i;' % (sql_s, sql_f, sql_f, sql_t, sql_w, sql_o, lmax, lmin)
             elif self._db._dbname == 'mssql' or \
                  self._db._dbname == 'mssql2':
                 if not attributes.get('orderby', None):
-                    sql_o += ' ORDER BY %s' % ', '.join([t + '.id'
+                    sql_o[-1] += ' ORDER BY %s' % ', '.join([t + '.id'
                             for t in tablenames])
                 sql_s += ' TOP %i' % lmax
             elif self._db._dbname == 'firebird':
                 if not attributes.get('orderby', None):
-                    sql_o += ' ORDER BY %s' % ', '.join([t + '.id'
+                    sql_o[-1] += ' ORDER BY %s' % ', '.join([t + '.id'
                             for t in tablenames])
                 sql_s += ' FIRST %i SKIP %i' % (lmax - lmin, lmin)
             elif self._db._dbname == 'db2':
                 if not attributes.get('orderby', None):
-                    sql_o += ' ORDER BY %s' % ', '.join([t + '.id'
+                    sql_o[-1] += ' ORDER BY %s' % ', '.join([t + '.id'
                             for t in tablenames])
-                sql_o += ' FETCH FIRST %i ROWS ONLY' % lmax
+                sql_o[-1] += ' FETCH FIRST %i ROWS ONLY' % lmax
             else:
-                sql_o += ' LIMIT %i OFFSET %i' % (lmax - lmin, lmin)
-        return '%s %s FROM %s%s%s;' % (sql_s, sql_f, sql_t, sql_w,
-                sql_o)
+                sql_o[-1] += ' LIMIT %i OFFSET %i' % (lmax - lmin, lmin)
+        return SQLStatement(['%s %s FROM ' % (sql_s, sql_f)] + sql_t + sql_w
+                            + sql_o + [';'])
 
     def select(self, *fields, **attributes):
         """
         Always returns a SQLRows object, even if it may be empty
+        (or iterator over rows if stream=True, see iterselect)
         """
 
+        if attributes.pop('stream', False):
+            return self.iterselect(*fields, **attributes)
+        format = attributes.pop('format', None)
+        if format == 'columns':
+            return self._select_columns(fields, attributes)
+        elif format is not None:
+            raise SyntaxError, 'Invalid select format.'
+        rowtype = attributes.pop('rowtype', None)
+
         def response(query):
-            self._db['_lastsql'] = query
-            self._db._execute(query)
+            self._db._execute_statement(query)
             return self._db._cursor.fetchall()
 
         if not attributes.get('cache', None):
-            query = self._select(*fields, **attributes)
-            r = response(query)
+            (sql, params) = self._compile_select(fields, attributes)
+            self._db._execute_on(self._db._cursor, sql, params)
+            r = self._db._cursor.fetchall()
         else:
             (cache_model, time_expire) = attributes['cache']
             del attributes['cache']
             query = self._select(*fields, **attributes)
-            key = self._db._uri + '/' + query
+            key = self._db._uri + '/' + str(query)
             r = cache_model(key, lambda : response(query), time_expire)
         if self._db._dbname in ['mssql', 'mssql2', 'db2']:
             r = r[(attributes.get('limitby', None) or (0,))[0]:]
-        return SQLRows(self._db, r, *self.colnames)
+        rows = SQLRows(self._db, r, *self.colnames)
+        rows.rowtype = rowtype
+        return rows
+
+    def _compile_select(self, fields, attributes):
+        """
+        returns (sql, params) of select; SQL of selects with the same shape
+        (same tables, fields, attributes and where with other values) is
+        built and compiled only once and cached in db._statements
+        """
+
+        params = []
+        key = (sql_shape(self._where, params), sql_shape(fields, params),
+               sql_shape(sorted(attributes.items()), params))
+        db = self._db
+        compiled = db._statements.get(key)
+        if compiled is None:
+            query = self._select(*fields, **attributes)
+            sql = db._compile(query.parts)[0]
+            index = dict([(id(param), i) for (i, param) in
+                         enumerate(params)])
+            order = [index.get(id(part)) for part in query.parts
+                     if isinstance(part, SQLParam)]
+            if None in order:
+                # value which isn't part of the key, don't cache
+                return db._compile(query.parts)
+            compiled = (sql, order, self.colnames)
+            db._statements[key] = compiled
+        (sql, order, self.colnames) = compiled
+        dbname = db._dbname
+        return (sql, [sql_param(params[i].value, params[i].type, dbname)
+                for i in order])
+
+    def iterselect(self, *fields, **attributes):
+        """
+        like select, but yields rows one by one. They are fetched in
+        batches of batch_size rows (default 1000) by its own cursor
+        (server side cursor on postgres and mysql), so memory doesn't grow
+        with number of rows and other queries can run while iterating (not
+        on mysql).
+        """
+
+        for rows in self._batches(fields, attributes):
+            for i in xrange(len(rows)):
+                yield rows[i]
+
+    def iterjson(self, *fields, **attributes):
+        """
+        like select, but yields rows serialized to JSON array (or NDJSON if
+        ndjson=True) in chunks, one per batch (see iterselect). mode is
+        'object' or 'array' like in SQLRows.json
+        """
+
+        mode = attributes.pop('mode', 'object')
+        ndjson = attributes.pop('ndjson', False)
+        return json_chunks((rows._json_items(mode) for rows in
+                           self._batches(fields, attributes)), ndjson)
+
+    def itercsv(self, *fields, **attributes):
+        """
+        like select, but yields rows serialized to CSV (like
+        SQLRows.export_to_csv_file) in chunks, one per batch (see
+        iterselect)
+        """
+
+        null = attributes.pop('null', '<NULL>')
+        s = cStringIO.StringIO()
+        writer = csv.writer(s)
+        header = False
+        for rows in self._batches(fields, attributes):
+            if not header:
+                writer.writerow(rows.colnames)
+                header = True
+            writer.writerows(rows._csv_rows(null))
+            yield s.getvalue()
+            s.seek(0)
+            s.truncate()
+        if not header:
+            # no rows, colnames were set when select was compiled
+            writer.writerow(self.colnames)
+            yield s.getvalue()
+
+    def export_to_csv_file(self, ofile, *fields, **attributes):
+        """
+        writes selected rows to CSV file, in batches (see itercsv)
+        """
+
+        for chunk in self.itercsv(*fields, **attributes):
+            ofile.write(chunk)
+
+    def _select_columns(self, fields, attributes):
+        """
+        select(format='columns'): returns SQLStorage of columns (by field
+        names, table.field if there are more tables), read in batches
+        """
+
+        columns = None
+        for rows in self._batches(fields, attributes):
+            if columns is None:
+                columns = []
+                for (tablename, fieldname, decode, table) in rows._columns:
+                    if tablename is None:
+                        fieldtype = None
+                    else:
+                        fieldtype = self._db[tablename][fieldname].type
+                    columns.append(SQLColumn(fieldtype, decode))
+                names = rows._names('.', True)
+            for (column, values) in zip(columns, zip(*rows.response)):
+                column.extend(values)
+        if columns is None:
+            # no rows
+            rows = SQLRows(self._db, [], *self.colnames)
+            return SQLStorage([(name, []) for name in rows._names('.',
+                              True)])
+        return SQLStorage([(name, column.result()) for (name, column) in
+                          zip(names, columns)])
+
+    def _batches(self, fields, attributes):
+        """
+        executes select on its own cursor and yields SQLRows of up to
+        batch_size rows. If connection had to be taken from the pool (e.g.
+        generator returned as response body is iterated after the end of
+        request), it's committed and given back when it's done.
+        """
+
+        batch_size = attributes.pop('batch_size', 1000)
+        rowtype = attributes.pop('rowtype', None)
+        db = self._db
+        (sql, params) = self._compile_select(fields, attributes)
+        colnames = self.colnames
+        skip = 0
+        if db._dbname in ['mssql', 'mssql2', 'db2']:
+            skip = (attributes.get('limitby', None) or (0,))[0]
+        (columns, factories) = (None, {})
+        acquired = db._local.connection is None
+        cursor = db._stream_cursor(batch_size)
+        try:
+            db._execute_on(cursor, sql, params)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                if skip:
+                    (batch, skip) = (batch[skip:], max(0, skip - len(batch)))
+                rows = SQLRows(db, batch, *colnames)
+                rows.rowtype = rowtype
+                # decoders are compiled only for the first batch
+                (rows._columns, rows._factory) = (columns, factories)
+                columns = columns or rows._compile()
+                yield rows
+        finally:
+            cursor.close()
+            if acquired:
+                db._release(SQLDB.commit)
 
     def _count(self):
         return self._select('count(*)')
@@ -2024,17 +3364,13 @@ class SQLSet(object):
             raise SyntaxError, \
                 'SQLSet: unable to determine what to delete'
         tablename = self._tables[0]
-        if self.sql_w:
-            sql_w = ' WHERE ' + self.sql_w
-        else:
-            sql_w = ''
-        return 'DELETE FROM %s%s;' % (tablename, sql_w)
+        return SQLStatement(['DELETE FROM %s' % tablename]
+                            + self._where_parts() + [';'])
 
     def delete(self):
         query = self._delete()
         self.delete_uploaded_files()
-        self._db['_lastsql'] = query
-        self._db._execute(query)
+        self._db._execute_statement(query)
         try:
             return self._db._cursor.rowcount
         except:
@@ -2050,22 +3386,16 @@ class SQLSet(object):
                              for field in table.fields if not field
                               in update_fields and table[field].update
                               != None]))
-        sql_v = 'SET ' + ', '.join(['%s=%s' % (field,
-                                   sql_represent(value,
-                                   table[field].type, dbname))
-                                   for (field, value) in
-                                   update_fields.items()])
-        if self.sql_w:
-            sql_w = ' WHERE ' + self.sql_w
-        else:
-            sql_w = ''
-        return 'UPDATE %s %s%s;' % (sql_t, sql_v, sql_w)
+        sql_v = join_parts([['%s=' % field, sql_value(value,
+                           table[field].type, dbname)] for (field,
+                           value) in update_fields.items()], ', ')
+        return SQLStatement(['UPDATE %s SET ' % sql_t] + sql_v
+                            + self._where_parts() + [';'])
 
     def update(self, **update_fields):
         query = self._update(**update_fields)
         self.delete_uploaded_files(update_fields)
-        self._db['_lastsql'] = query
-        self._db._execute(query)
+        self._db._execute_statement(query)
         try:
             return self._db._cursor.rowcount
         except:
@@ -2103,15 +3433,232 @@ def update_record(t, s, a):
         t[str(key)] = value
 
 
+def decode_blob(value):
+    return base64.b64decode(str(value))
+
+
+def decode_boolean(value):
+    return value == True or value == 'T' or value == 't'
+
+
+def decode_date(value):
+    if isinstance(value, datetime.date) \
+        and not isinstance(value, datetime.datetime):
+        return value
+    (y, m, d) = [int(x) for x in str(value)[:10].strip().split('-')]
+    return datetime.date(y, m, d)
+
+
+def decode_time(value):
+    if isinstance(value, datetime.time):
+        return value
+    time_items = [int(x) for x in str(value)[:8].strip().split(':')[:3]]
+    if len(time_items) == 3:
+        (h, mi, s) = time_items
+    else:
+        (h, mi, s) = time_items + [0]
+    return datetime.time(h, mi, s)
+
+
+def decode_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    (y, m, d) = [int(x) for x in str(value)[:10].strip().split('-')]
+    time_items = [int(x) for x in str(value)[11:19].strip().split(':')[:3]]
+    if len(time_items) == 3:
+        (h, mi, s) = time_items
+    else:
+        (h, mi, s) = time_items + [0]
+    return datetime.datetime(y, m, d, h, mi, s)
+
+
+SQL_DECODERS = {
+    'blob': decode_blob,
+    'boolean': decode_boolean,
+    'date': decode_date,
+    'time': decode_time,
+    'datetime': decode_datetime,
+    }
+
+
+def sql_decoder(fieldtype):
+    """
+    returns function which converts value (not None) of field of given
+    type from database, or None if value is used as it is
+    """
+
+    if isinstance(fieldtype, SQLCustomType):
+        return fieldtype.decoder
+    return SQL_DECODERS.get(fieldtype, None)
+
+
+def json_default(value):
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError, '%r is not JSON serializable' % value
+
+
+def json_dumps(obj):
+    return json.dumps(obj, default=json_default, separators=(',', ':'))
+
+
+def json_chunks(batches, ndjson=False):
+    """
+    serializes lists of items to JSON array (or NDJSON), chunk per list
+    """
+
+    if ndjson:
+        for items in batches:
+            if items:
+                yield ''.join([json_dumps(item) + '\n' for item in items])
+        return
+    yield '['
+    separator = ''
+    for items in batches:
+        if items:
+            yield separator + json_dumps(items)[1:-1]
+            separator = ','
+    yield ']'
+
+
+def csv_encoder(decode, null):
+    """
+    returns function which converts value of column from database (with
+    decoder of its field) to CSV
+    """
+
+    def encode(value):
+        if value is None:
+            return null
+        if decode is not None:
+            value = decode(value)
+        if isinstance(value, unicode):
+            return value.encode('utf8')
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()[:19].replace('T', ' ')
+        return value
+    return encode
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def date_to_days(value):
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+def days_to_date(value):
+    return datetime.date.fromordinal(int(value) + EPOCH_ORDINAL)
+
+
+def datetime_to_seconds(value):
+    delta = value - EPOCH
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def seconds_to_datetime(value):
+    return EPOCH + datetime.timedelta(seconds=value)
+
+
+def seconds_to_numpy(value):
+    return (value * 1e6).astype('int64').astype('datetime64[us]')
+
+
+# typecode of array, functions converting value to number in array and
+# back, function converting array to numpy array
+SQL_COLUMNS = {
+    'id': ('l', None, None, None),
+    'integer': ('l', None, None, None),
+    'reference': ('l', None, None, None),
+    'double': ('d', None, None, None),
+    'boolean': ('b', int, bool, lambda a: a.astype(bool)),
+    'date': ('l', date_to_days, days_to_date,
+             lambda a: a.astype('datetime64[D]')),
+    'datetime': ('d', datetime_to_seconds, seconds_to_datetime,
+                 seconds_to_numpy),
+    }
+
+
+class SQLColumn(object):
+
+    """
+    values of one column of select(format='columns'), collected in
+    array.array if field is numeric, date or datetime (days or seconds
+    since 1970-01-01) and has no NULLs, in list otherwise
+    """
+
+    __slots__ = ('decode', 'kind', 'values')
+
+    def __init__(self, fieldtype, decode):
+        self.decode = decode
+        if isinstance(fieldtype, str) and fieldtype[:9] == 'reference':
+            fieldtype = 'reference'
+        self.kind = SQL_COLUMNS.get(fieldtype, None)
+        if self.kind is None:
+            self.values = []
+        else:
+            self.values = array.array(self.kind[0])
+
+    def extend(self, values):
+        decode = self.decode
+        if decode is not None:
+            values = list(values)
+            for j in xrange(len(values)):
+                if values[j] is not None:
+                    values[j] = decode(values[j])
+        if self.kind is not None and None in values:
+            # NULL doesn't fit into array
+            self.values = self.tolist()
+            self.kind = None
+        if self.kind is None:
+            self.values.extend(values)
+            return
+        encode = self.kind[1]
+        if encode is not None:
+            values = [encode(value) for value in values]
+        self.values.extend(values)
+
+    def tolist(self):
+        if self.kind is None or self.kind[2] is None:
+            return list(self.values)
+        return [self.kind[2](value) for value in self.values]
+
+    def result(self):
+        """
+        numpy array (if numpy is installed), array.array or list
+        """
+
+        if self.kind is None or numpy is None:
+            return self.values
+        if not len(self.values):
+            values = numpy.zeros(0, self.values.typecode)
+        else:
+            values = numpy.frombuffer(self.values, self.values.typecode)
+        if self.kind[3] is not None:
+            values = self.kind[3](values)
+        return values
+
+
 class SQLRows(object):
 
     """
     A wrapper for the retun value of a select. It basically represents a table.
     It has an iterator and each row is represented as a dictionary.
+
+    If rowtype is 'tuple', 'namedtuple' or 'dict' rows are plain tuples,
+    namedtuples or dicts of values, without update_record and referenced
+    sets.
+
+    Rows are decoded once and cached, so rows[0] is always the same object
+    and its changes are seen by later reads (as_list returns copies).
     """
 
     # ## this class still needs some work to care for ID/OID
 
+    __slots__ = ('_db', 'colnames', 'response', 'hooks', 'compact',
+                 'rowtype', '_columns', '_factory', '_cache')
+
     def __init__(
         self,
         db,
@@ -2123,6 +3670,21 @@ class SQLRows(object):
         self.response = response
         self.hooks = True
         self.compact = True
+        self.rowtype = None
+        self._columns = None
+        self._factory = {}
+        # decoded rows, list per (rowtype, compact, hooks)
+        self._cache = {}
+
+    def __getstate__(self):
+        # compiled decoders and cached rows are rebuilt after unpickling
+        return (self._db, self.colnames, self.response, self.hooks,
+                self.compact, self.rowtype)
+
+    def __setstate__(self, state):
+        (db, colnames, response, hooks, compact, rowtype) = state
+        self.__init__(db, response, *colnames)
+        (self.hooks, self.compact, self.rowtype) = (hooks, compact, rowtype)
 
     def __nonzero__(self):
         if len(self.response):
@@ -2132,96 +3694,159 @@ class SQLRows(object):
     def __len__(self):
         return len(self.response)
 
+    def _compile(self):
+        """
+        builds, once per result set, (tablename, fieldname, decoder, table)
+        of every column; tablename is None for expressions (they go to
+        row._extra), table is set only for id fields, which get hooks
+        """
+
+        columns = []
+        for colname in self.colnames:
+            if not table_field.match(colname):
+                columns.append((None, colname, None, None))
+                continue
+            (tablename, fieldname) = colname.split('.')
+            table = self._db[tablename]
+            if fieldname != 'id':
+                columns.append((tablename, fieldname,
+                               sql_decoder(table[fieldname].type), None))
+            else:
+                columns.append((tablename, fieldname,
+                               sql_decoder(table[fieldname].type), table))
+        self._columns = columns
+        return columns
+
+    def _names(self, separator, compact):
+        """
+        names of columns, just field names if all are from one table
+        """
+
+        columns = self._columns or self._compile()
+        tablenames = set([tablename for (tablename, fieldname, decode,
+                         table) in columns])
+        if compact and len(tablenames) == 1 and not None in tablenames:
+            return [fieldname for (tablename, fieldname, decode, table) in
+                    columns]
+        return [tablename is None and fieldname or tablename + separator
+                + fieldname for (tablename, fieldname, decode, table) in
+                columns]
+
+    def _compile_factory(self, rowtype, compact):
+        """
+        returns function which makes row of rowtype from list of values
+        """
+
+        if rowtype == 'tuple':
+            factory = tuple
+        elif rowtype == 'namedtuple':
+            factory = collections.namedtuple('Row', self._names('_',
+                    compact), rename=True)._make
+        elif rowtype == 'dict':
+            keys = self._names('.', compact)
+            factory = lambda values: dict(zip(keys, values))
+        else:
+            raise SyntaxError, 'SQLRows: invalid rowtype'
+        self._factory[(rowtype, compact)] = factory
+        return factory
+
     def __getitem__(self, i):
         if i >= len(self.response) or i < 0:
             raise SyntaxError, 'SQLRows: no such row'
-        if len(self.response[0]) != len(self.colnames):
-            raise SyntaxError, 'SQLRows: internal error'
+        return self._row(i, self.rowtype, self.compact, self.hooks)
+
+    def _row(self, i, rowtype, compact, hooks):
+        """
+        row i, decoded only on first access in given mode
+        """
+
+        key = (rowtype, compact, hooks)
+        rows = self._cache.get(key)
+        if rows is None:
+            if len(self.response[0]) != len(self.colnames):
+                raise SyntaxError, 'SQLRows: internal error'
+            rows = self._cache[key] = [None] * len(self.response)
+        row = rows[i]
+        if row is None:
+            if rowtype is None:
+                row = rows[i] = self._record(i, compact, hooks)
+            else:
+                row = rows[i] = self._values(i, rowtype, compact)
+        return row
+
+    def _values(self, i, rowtype, compact):
+        """
+        row i of rowtype
+        """
+
+        columns = self._columns or self._compile()
+        factory = self._factory.get((rowtype, compact)) \
+            or self._compile_factory(rowtype, compact)
+        values = []
+        for ((tablename, fieldname, decode, table), value) in \
+            zip(columns, self.response[i]):
+            if decode is not None and value is not None:
+                value = decode(value)
+            values.append(value)
+        return factory(values)
+
+    def _record(self, i, compact, hooks):
+        """
+        row i as SQLStorage (of SQLStorages, one per table, if not compact)
+        """
+
+        columns = self._columns or self._compile()
+        setitem = dict.__setitem__
         row = SQLStorage()
-        for j in xrange(len(self.colnames)):
-            value = self.response[i][j]
-            if not table_field.match(self.colnames[j]):
+        ids = []
+        for ((tablename, fieldname, decode, table), value) in \
+            zip(columns, self.response[i]):
+            if tablename is None:
                 if not '_extra' in row:
-                    row['_extra'] = SQLStorage()
-                row['_extra'][self.colnames[j]] = value
+                    setitem(row, '_extra', SQLStorage())
+                setitem(row['_extra'], fieldname, value)
                 continue
-            (tablename, fieldname) = self.colnames[j].split('.')
-            table = self._db[tablename]
-            field = table[fieldname]
-            if not tablename in row:
-                row[tablename] = SQLStorage()
-            if field.type[:9] == 'reference':
-                referee = field.type[10:].strip()
-                rid = value
-                row[tablename][fieldname] = rid
-            elif field.type == 'blob' and value != None:
-                row[tablename][fieldname] = base64.b64decode(str(value))
-            elif field.type == 'boolean' and value != None:
-                if value == True or value == 'T' or value == 't':
-                    row[tablename][fieldname] = True
-                else:
-                    row[tablename][fieldname] = False
-            elif field.type == 'date' and value != None\
-                 and (not isinstance(value, datetime.date)\
-                      or isinstance(value, datetime.datetime)):
-                (y, m, d) = [int(x) for x in
-                             str(value)[:10].strip().split('-')]
-                row[tablename][fieldname] = datetime.date(y, m, d)
-            elif field.type == 'time' and value != None\
-                 and not isinstance(value, datetime.time):
-                time_items = [int(x) for x in
-                              str(value)[:8].strip().split(':')[:3]]
-                if len(time_items) == 3:
-                    (h, mi, s) = time_items
-                else:
-                    (h, mi, s) = time_items + [0]
-                row[tablename][fieldname] = datetime.time(h, mi, s)
-            elif field.type == 'datetime' and value != None\
-                 and not isinstance(value, datetime.datetime):
-                (y, m, d) = [int(x) for x in
-                             str(value)[:10].strip().split('-')]
-                time_items = [int(x) for x in
-                              str(value)[11:19].strip().split(':')[:3]]
-                if len(time_items) == 3:
-                    (h, mi, s) = time_items
-                else:
-                    (h, mi, s) = time_items + [0]
-                row[tablename][fieldname] = datetime.datetime(y, m, d, h, mi, s)
-            elif isinstance(field.type,SQLCustomType) and value != None:
-                row[tablename][fieldname] = field.type.decoder(value)
+            if decode is not None and value is not None:
+                value = decode(value)
+            if tablename in row:
+                setitem(row[tablename], fieldname, value)
             else:
-                row[tablename][fieldname] = value
-            if fieldname == 'id' and self.hooks:
-                id = row[tablename].id
-                row[tablename].update_record = lambda t = row[tablename], \
-                    s = self._db(table.id == id), **a: update_record(t, s, a)
-                for (referee_table, referee_name) in \
-                    table._referenced_by:
-                    s = self._db[referee_table][referee_name]
-                    row[tablename][referee_table] = SQLSet(self._db, s == id)
+                setitem(row, tablename, SQLStorage({fieldname: value}))
+            if table is not None and hooks:
+                ids.append((tablename, table))
+        for (tablename, table) in ids:
+            id = row[tablename].id
+            row[tablename].update_record = lambda t = row[tablename], \
+                s = self._db(table.id == id), **a: update_record(t, s, a)
+            for (referee_table, referee_name) in \
+                table._referenced_by:
+                s = self._db[referee_table][referee_name]
+                row[tablename][referee_table] = SQLSet(self._db, s == id)
         keys = row.keys()
-        if self.compact and len(keys) == 1 and keys[0] != '_extra':
-            return row[row.keys()[0]]
+        if compact and len(keys) == 1 and keys[0] != '_extra':
+            return row[keys[0]]
         return row
 
     def as_list(self,
                 compact=True,
                 storage_to_dict=True,
                 datetime_to_str=True):
-        (compact, self.compact) = (self.compact, compact)
-        (hooks, self.hooks) = (self.hooks, False)
         def dictit(d):
+            # row is cached, caller gets copy
             if storage_to_dict:
                 d = dict(d)
-            if datetime_to_str:
-                for k in d:
-                    v = d[k]
-                    if isinstance(v, (datetime.date, datetime.datetime, datetime.time)):
-                        d[k] = v.isoformat().replace('T',' ')[:19]
+            else:
+                d = SQLStorage(d)
+            for k in d:
+                v = d[k]
+                if isinstance(v, SQLStorage):
+                    # values of one table in not compact row
+                    d[k] = SQLStorage(v)
+                elif datetime_to_str and isinstance(v, (datetime.date, datetime.datetime, datetime.time)):
+                    d[k] = v.isoformat().replace('T',' ')[:19]
             return d
-        items = [dictit(item) for item in self]
-        (self.hooks, self.compact) =  (hooks, compact)
-        return items
+        return [dictit(self._row(i, None, compact, False)) for i in
+                xrange(len(self))]
 
     def __iter__(self):
         """
@@ -2231,31 +3856,31 @@ class SQLRows(object):
         for i in xrange(len(self)):
             yield self[i]
 
+    def records(self):
+        """
+        iterator over records as SQLStorage (default rowtype), whatever
+        rowtype is; used by SQLTABLE
+        """
+
+        for i in xrange(len(self)):
+            yield self._row(i, None, self.compact, self.hooks)
+
+    def _csv_rows(self, null):
+        """
+        yields rows for csv.writer, straight from the response
+        """
+
+        columns = self._columns or self._compile()
+        encoders = [csv_encoder(decode, null) for (tablename, fieldname,
+                    decode, table) in columns]
+        for record in self.response:
+            yield [encode(value) for (encode, value) in zip(encoders,
+                   record)]
+
     def export_to_csv_file(self, ofile, null='<NULL>'):
         writer = csv.writer(ofile)
         writer.writerow(self.colnames)
-
-        def none_exception(value):
-            if isinstance(value, unicode):
-                return value.encode('utf8')
-            if hasattr(value, 'isoformat'):
-                return value.isoformat()[:19].replace('T', ' ')
-            if value == None:
-                return null
-            return value
-
-        for record in self:
-            row = []
-            for col in self.colnames:
-                if not table_field.match(col):
-                    row.append(record._extra[col])
-                else:
-                    (t, f) = col.split('.')
-                    if isinstance(record.get(t, None), SQLStorage):
-                        row.append(none_exception(record[t][f]))
-                    else:
-                        row.append(none_exception(record[f]))
-            writer.writerow(row)
+        writer.writerows(self._csv_rows(null))
 
     def __str__(self):
         """
@@ -2274,38 +3899,47 @@ class SQLRows(object):
         import sqlhtml
         return sqlhtml.SQLTABLE(self).xml()
 
-    def json(self, mode='object'):
+    def _json_items(self, mode, start=0, stop=None):
         """
-        serializes the table to a JSON list of objects
+        decoded rows (from start to stop) as dicts (mode 'object') or lists
+        (mode 'array') for JSON, straight from the response
         """
 
         mode = mode.lower()
         if not mode in ['object', 'array']:
             raise SyntaxError, 'Invalid JSON serialization mode.'
+        columns = self._columns or self._compile()
+        decoders = [(j, decode) for (j, (tablename, fieldname, decode,
+                    table)) in enumerate(columns) if decode is not None]
+        items = []
+        for record in self.response[start:stop]:
+            values = list(record)
+            for (j, decode) in decoders:
+                if values[j] is not None:
+                    values[j] = decode(values[j])
+            items.append(values)
+        if mode == 'object':
+            # table.field keys for joins, like in rowtype 'dict'
+            keys = self._names('.', True)
+            items = [dict(zip(keys, values)) for values in items]
+        return items
 
-        def inner_loop(record, col):
-            (t, f) = col.split('.')
-            res = None
-            if not table_field.match(col):
-                res = record._extra[col]
-            else:
-                if isinstance(record.get(t, None), SQLStorage):
-                    res = record[t][f]
-                else:
-                    res = record[f]
-            if mode == 'object':
-                return (f, res)
-            else:
-                return res
+    def json(self, mode='object'):
+        """
+        serializes the table to a JSON list of objects (or lists if mode is
+        'array'), dates and times in ISO format
+        """
 
-        if mode == 'object':
-            items = [dict([inner_loop(record, col) for col in
-                     self.colnames]) for record in self]
-        else:
-            items = [[inner_loop(record, col) for col in self.colnames]
-                     for record in self]
+        return json_dumps(self._json_items(mode))
 
-        return json(items)
+    def iterjson(self, mode='object', ndjson=False, chunk_size=1000):
+        """
+        like json, but yields JSON array (or NDJSON if ndjson=True) in
+        chunks of chunk_size rows
+        """
+
+        return json_chunks((self._json_items(mode, i, i + chunk_size)
+                           for i in xrange(0, len(self), chunk_size)), ndjson)
 
 
 def test_all():
@@ -2371,6 +4005,15 @@ def test_all():
     >>> me.name
     'Max'
 
+    Values are sent to database as parameters, _select shows them inlined
+
+    >>> print db(db.person.name=='Max')._select(db.person.id)
+    SELECT person.id FROM person WHERE person.name='Max';
+    >>> len(db(db.person.name=='Max').select())
+    1
+    >>> len(db._lastparams)
+    1
+
     Examples of complex search conditions
 
     >>> len(db((db.person.name=='Max')&(db.person.birth<'2003-01-01')).select())
@@ -2487,12 +4130,222 @@ def test_all():
     >>> db(mynumber.x+2==5).select(mynumber.x+2)[0]._extra[mynumber.x+2]
     5
 
+    Bulk insert
+
+    >>> mynumber.bulk_insert([dict(x=i) for i in range(10, 13)])
+    3
+    >>> len(mynumber.bulk_insert([dict(x=i) for i in range(3)], ids=True))
+    3
+
     Output in csv
 
     >>> print str(authored_papers.select(db.author.name,db.paper.title)).strip()
     author.name,paper.title\r
     Massimo,QCD
 
+    Pool gives out at most max_size connections, next get waits at most
+    timeout seconds
+
+    >>> pool=SQLConnectionPool(lambda: sqlite3.Connection(':memory:'),\
+                               max_size=1,idle_size=1,timeout=0.1)
+    >>> connection=pool.get()
+    >>> pool.get()
+    Traceback (most recent call last):
+    ...
+    SQLPoolTimeout: no free connection in 0.1 seconds
+    >>> pool.put(connection)
+    >>> pool.get() is connection
+    True
+    >>> stats=pool.stats()
+    >>> (stats['in_use'],stats['idle'],stats['opened'],stats['timeouts'])
+    (1, 0, 1, 1)
+
+    Connections idle for ping_after seconds (30 by default) are pinged,
+    dead ones are replaced
+
+    >>> def ping(connection): connection.execute('SELECT 1')
+    >>> pool=SQLConnectionPool(lambda: sqlite3.Connection(':memory:'),\
+                               ping=ping,idle_size=1)
+    >>> pool.ping_after
+    30
+    >>> pool.ping_after=0
+    >>> connection=pool.get()
+    >>> pool.put(connection)
+    >>> connection.close()
+    >>> pool.get() is connection
+    False
+    >>> (pool.stats()['broken'],pool.stats()['opened'])
+    (1, 2)
+
+    Selects are compiled once per shape of query, values are bound anew
+
+    >>> db._statements.clear()
+    >>> [r.x for r in db(mynumber.x==3).select(mynumber.x)]
+    [3]
+    >>> [r.x for r in db(mynumber.x==4).select(mynumber.x)]
+    [4]
+    >>> len(db._statements)
+    1
+    >>> [r.x for r in db((mynumber.x>6)&(mynumber.x<9)).select(mynumber.x,orderby=mynumber.x)]
+    [7, 8]
+    >>> len(db._statements)
+    2
+
+    Queries know their tables, values are not part of their shape
+
+    >>> query=(db.author.id==db.authorship.author_id)&(db.paper.title=='QCD')
+    >>> query._tables
+    ['author', 'authorship', 'paper']
+    >>> other=(db.author.id==db.authorship.author_id)&(db.paper.title=='QED')
+    >>> query._shape()[0]==other._shape()[0]
+    True
+    >>> [p.value for p in other._shape()[1]]
+    ['QED']
+    >>> (~db.paper.title.like('Q%'))._tables
+    ['paper']
+    >>> SQLQuery('paper.id>0')._tables
+    ['paper']
+    >>> len(db(query).select(db.paper.title))
+    1
+
+    CSV import in chunks, records with known uuid are updated
+
+    >>> tmp=db.define_table('item',SQLField('uuid'),SQLField('name'),\
+              migrate='test_item.table')
+    >>> data='item.id,item.uuid,item.name\\r\\n1,a,first\\r\\n2,b,second\\r\\n'
+    >>> stats=db.item.import_from_csv_file(cStringIO.StringIO(data),chunk_size=1)
+    >>> (stats['rows'],stats['inserted'],stats['updated'])
+    (2, 2, 0)
+    >>> data='item.id,item.uuid,item.name\\r\\n1,a,changed\\r\\n3,c,third\\r\\n4,d,<NULL>\\r\\n'
+    >>> stats=db.item.import_from_csv_file(cStringIO.StringIO(data),chunk_size=2)
+    >>> (stats['rows'],stats['inserted'],stats['updated'])
+    (3, 2, 1)
+    >>> [(str(r.uuid),r.name and str(r.name)) for r in db().select(db.item.ALL,orderby=db.item.uuid)]
+    [('a', 'changed'), ('b', 'second'), ('c', 'third'), ('d', None)]
+    >>> db.item.drop()
+
+    Upsert, keys have to be unique in database
+
+    >>> tmp=db.define_table('member',SQLField('email',unique=True),\
+              SQLField('name'),SQLField('note',update='updated'),\
+              migrate='test_member.table')
+    >>> db.member.upsert(keys=['email'],email='a@x.org',name='a')
+    1
+    >>> db.member.bulk_upsert([dict(email='a@x.org',name='b'),\
+                              dict(email='c@x.org',name='c')],['email'])
+    2
+    >>> [(str(r.email),str(r.name)) for r in db().select(db.member.ALL,orderby=db.member.email)]
+    [('a@x.org', 'b'), ('c@x.org', 'c')]
+    >>> db.member.bulk_upsert([dict(email='a@x.org',name='d'),\
+                              dict(email='c@x.org',name='e',note='mine')],['email'])
+    2
+    >>> [str(r.note) for r in db().select(db.member.ALL,orderby=db.member.email)]
+    ['updated', 'mine']
+    >>> db.member.upsert(keys=['id'],id=1,name='x')
+    Traceback (most recent call last):
+    ...
+    ValueError: upsert: id is assigned by database, it can't be a key
+    >>> db.member.drop()
+
+    Rows streamed in batches, other queries can run meanwhile
+
+    >>> rows=db(mynumber.x<5).iterselect(mynumber.x,orderby=mynumber.x,batch_size=3)
+    >>> [(r.x,len(db(mynumber.x==r.x).select())) for r in rows]
+    [(0, 2), (0, 2), (1, 2), (1, 2), (2, 2), (2, 2), (3, 1), (4, 1)]
+    >>> [r.x for r in db(mynumber.x>10).select(mynumber.x,orderby=mynumber.x,stream=True)]
+    [11, 12]
+
+    Values are converted by decoders of column types
+
+    >>> print sql_decoder('string')
+    None
+    >>> sql_decoder('date')('2008-01-02')
+    datetime.date(2008, 1, 2)
+    >>> sql_decoder('boolean')('F')
+    False
+    >>> tmp=db.define_table('event',SQLField('active','boolean'),\
+              SQLField('day','date'),SQLField('author',db.author),\
+              migrate='test_event.table')
+    >>> tmp=db.event.insert(active=True,day=datetime.date(2008,1,2),author=aid)
+    >>> row=db().select(db.event.ALL)[0]
+    >>> (row.active,row.day,row.author==aid)
+    (True, datetime.date(2008, 1, 2), True)
+    >>> len(db(db.author.id==aid).select()[0].event.select())
+    1
+    >>> db.event.drop()
+
+    Rows of other types
+
+    >>> query=mynumber.x>=10
+    >>> db(query).select(mynumber.x,orderby=mynumber.x,rowtype='tuple')[0]
+    (10,)
+    >>> db(query).select(mynumber.x,orderby=mynumber.x,rowtype='namedtuple')[1]
+    Row(x=11)
+    >>> db(query).select(mynumber.x,orderby=mynumber.x,rowtype='dict')[2]
+    {'x': 12}
+    >>> rows=db(db.author.id==db.authorship.author_id).select(db.author.name,\
+              db.authorship.paper_id,rowtype='dict')
+    >>> sorted(rows[0].keys())
+    ['author.name', 'authorship.paper_id']
+    >>> db(query).select(mynumber.x,orderby=mynumber.x,rowtype='tuple').xml()[:31]
+    '<table><thead><tr><th>mynumber.'
+
+    Rows are decoded once, on first access, they can be pickled (e.g. by
+    FileCache)
+
+    >>> rows=db(mynumber.x>=10).select(mynumber.ALL,orderby=mynumber.x)
+    >>> rows[0] is rows[0]
+    True
+    >>> [r['x'] for r in rows.as_list()]
+    [10, 11, 12]
+    >>> rows.as_list(compact=False)[0]['mynumber']['x']=0
+    >>> rows.as_list(compact=False)[0]['mynumber']['x']
+    10
+    >>> copy=cPickle.loads(cPickle.dumps(rows,cPickle.HIGHEST_PROTOCOL))
+    >>> [r.x for r in copy]==[r.x for r in rows]
+    True
+
+    Rows as JSON, dates and times in ISO format
+
+    >>> rows=db(mynumber.x>=11).select(mynumber.x,orderby=mynumber.x)
+    >>> rows.json()
+    '[{"x":11},{"x":12}]'
+    >>> rows.json(mode='array')
+    '[[11],[12]]'
+    >>> ''.join(rows.iterjson(chunk_size=1))
+    '[{"x":11},{"x":12}]'
+    >>> list(db(mynumber.x>=11).iterjson(mynumber.x,orderby=mynumber.x,\
+                                         mode='array',ndjson=True,batch_size=1))
+    ['[11]\\n', '[12]\\n']
+    >>> rows=db(db.author.id==db.authorship.author_id).select(db.author.id,\
+              db.authorship.id)
+    >>> sorted(json.loads(rows.json())[0].keys())
+    [u'author.id', u'authorship.id']
+    >>> json_dumps([datetime.date(2008,1,2),datetime.datetime(2008,1,2,3,4,5)])
+    '["2008-01-02","2008-01-02T03:04:05"]'
+
+    CSV export in batches gives the same as export of selected rows
+
+    >>> list(db(mynumber.x>=11).itercsv(mynumber.x,orderby=mynumber.x,batch_size=1))
+    ['mynumber.x\\r\\n11\\r\\n', '12\\r\\n']
+    >>> ofile=cStringIO.StringIO()
+    >>> db(mynumber.x>=11).export_to_csv_file(ofile,mynumber.x,orderby=mynumber.x)
+    >>> ofile.getvalue()==str(db(mynumber.x>=11).select(mynumber.x,orderby=mynumber.x))
+    True
+
+    Results as columns
+
+    >>> columns=db(mynumber.x>=10).select(mynumber.id,mynumber.x,\
+                                          orderby=mynumber.x,format='columns')
+    >>> sorted(columns.keys())
+    ['id', 'x']
+    >>> (list(columns.x),sum(columns.x))
+    ([10, 11, 12], 33)
+    >>> db(mynumber.x>=10).select(format='rows')
+    Traceback (most recent call last):
+    ...
+    SyntaxError: Invalid select format.
+
     Delete all leftover tables
 
     # >>> SQLDB.distributed_transaction_commit(db)
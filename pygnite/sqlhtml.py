@@ -617,7 +617,7 @@ class SQLTABLE(TABLE):
                             + c)))
         components.append(THEAD(TR(*row)))
         tbody = []
-        for (rc, record) in enumerate(sqlrows):
+        for (rc, record) in enumerate(sqlrows.records()):
             row = []
             if rc % 2 == 0:
                 _class = 'even'
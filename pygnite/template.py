@@ -3,10 +3,61 @@
 
 # Jinja2 templates
 
+import os
+import logging
+
 from jinja2 import Environment 
 from jinja2 import FileSystemLoader
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import TemplateSyntaxError
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.utils import LRUCache
+
+from cache import MemoryCache
+from context import current
+from session import SESSION_KEY
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds ``cache`` tag, which caches rendered part of template::
+
+        {% cache 'menu' %}...{% endcache %}
+        {% cache 'sidebar-' ~ category, 300 %}...{% endcache %}
+
+    First argument is a key, second (optional) is time to live in seconds.
+    Fragments are stored in ``env.fragment_cache`` (``MemoryCache`` by
+    default), its ``stats()`` show hit rate.
+    """
+
+    tags = set(['cache'])
 
-env = Environment(loader=FileSystemLoader([]))
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        environment.extend(fragment_cache=MemoryCache())
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, caller):
+        cache = self.environment.fragment_cache
+        key = 'fragment:%s' % key
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment, ttl)
+        return fragment
+
+
+env = Environment(loader=FileSystemLoader([]), extensions=[FragmentCacheExtension])
 
 def append_path(paths):
     if isinstance(paths, str):
@@ -17,8 +68,80 @@ def append_path(paths):
             env.loader.searchpath.append(path)
 
 
+def configure_templates(cache_path=None, auto_reload=True, cache_size=None, precompile=False, fragment_cache=None):
+    """
+    Configure templates cache.
+
+    :param cache_path: Directory where compiled templates are stored, so new processes don't have to compile them again.
+    :param auto_reload: If False, template files aren't checked for changes once they are loaded (use it in production).
+    :param cache_size: Number of compiled templates kept in memory, -1 means all. Default: jinja's default.
+    :param precompile: If True, compile all templates from search paths now.
+    :param fragment_cache: Cache for ``{% cache %}`` fragments, e.g. ``FileCache('/dev/shm/fragments')`` to share them between processes. Default: ``MemoryCache``.
+    """
+
+    if cache_path:
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        env.bytecode_cache = FileSystemBytecodeCache(cache_path, '%s.cache')
+    env.auto_reload = auto_reload
+    if cache_size is not None:
+        if cache_size < 0:
+            env.cache = {}
+        else:
+            env.cache = LRUCache(cache_size)
+    if fragment_cache is not None:
+        env.fragment_cache = fragment_cache
+    if precompile:
+        precompile_templates()
+
+
+def precompile_templates():
+    """
+    Load (and compile) every template from search paths. Returns number of
+    compiled templates. Files which are not valid templates are skipped.
+    """
+
+    count = 0
+    for name in env.list_templates():
+        try:
+            env.get_template(name)
+            count += 1
+        except (TemplateSyntaxError, UnicodeDecodeError), e:
+            logging.warning('template %s not precompiled: %s' % (name, e))
+    return count
+
+
+def _session(request):
+    # session isn't loaded until template uses it (request.session would
+    # load it to move flash)
+    return request and request.get(SESSION_KEY)
+
+
 def render(template_name, **context):
-    from main import request
+    request = current.request
 
     template = env.get_template(template_name)
-    return template.render(request=request, session=request.session, **context)
+    return template.render(request=request, session=_session(request), **context)
+
+
+def render_stream(template_name, buffer_size=5, **context):
+    """
+    Render template piece by piece. Returns iterator of utf-8 encoded
+    chunks, which can be returned from controller or passed to ``Response``
+    as body, so big pages are sent while they are rendered.
+
+    :param template_name: Template name.
+    :param buffer_size: Number of template parts joined into one chunk.
+    """
+    request = current.request
+
+    template = env.get_template(template_name)
+    stream = template.stream(request=request, session=_session(request), **context)
+    if buffer_size > 1:
+        stream.enable_buffering(buffer_size)
+
+    def chunks():
+        for chunk in stream:
+            yield chunk.encode('utf-8')
+
+    return chunks()
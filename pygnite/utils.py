@@ -1,9 +1,10 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-__all__ = ['Storage', 'hash']
+__all__ = ['Storage', 'hash', 'LRU']
 
 import hashlib
+import threading
 
 class Storage(dict):
     """
@@ -36,3 +37,109 @@ def hash(value, digest_alg='md5'):
     h.update(value)
     return h.hexdigest()
 
+
+class LRU(object):
+    """
+    Thread-safe mapping which keeps only ``size`` most recently used items.
+
+    ::
+
+        cache = LRU(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')  # 'a' is now the most recent one
+        cache['c'] = 3  # 'b' is dropped
+
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._map = {}
+        # circular doubly linked list: [prev, next, key, value]
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, link):
+        (prev, next) = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                link = self._map[key] = [None, None, key, value]
+            self._append(link)
+            while len(self._map) > self.size:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._map[oldest[2]]
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.pop(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __delitem__(self, key):
+        if self.pop(key, self) is self:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def __len__(self):
+        return len(self._map)
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return self._map.keys()
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
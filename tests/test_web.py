@@ -0,0 +1,615 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# WSGI level tests of pygnite.
+# Run from the top directory: python -m unittest discover tests
+
+import os
+import sys
+import base64
+import cPickle
+import StringIO
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pygnite
+import beaker.session
+from beaker.middleware import SessionMiddleware as BeakerMiddleware
+from pygnite import main, template, http, hooks
+from pygnite.utils import Storage
+from pygnite.context import current
+from pygnite.cache import MemoryCache, FileCache
+from pygnite.session import SessionMiddleware, Session, CookieBackend, \
+    MemoryBackend, FileBackend, StoreBackend, LocalStore, SESSION_KEY
+
+
+def call(app, cookie=None, method='GET', path='/', query=''):
+    """
+    Call WSGI ``app``, return (status, headers, body).
+    """
+    env = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+           'wsgi.input': StringIO.StringIO('')}
+    if cookie:
+        env['HTTP_COOKIE'] = cookie
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+    result = app(env, start_response)
+    try:
+        body = ''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return (response[0], dict(response[1]), body)
+
+def counter(env, start_response):
+    session = env[SESSION_KEY]
+    session['count'] = session.get('count', 0) + 1
+    session.save()
+    start_response('200 OK', [])
+    return [str(session['count'])]
+
+def cookie_of(headers):
+    return headers['Set-Cookie'].split(';')[0]
+
+def app_with(backend):
+    """
+    Pygnite application with session ``backend``, as put together by ``pygnite()``.
+    """
+    main.debug = False
+    return main.stateless_app(main.create_app,
+                              SessionMiddleware(main.create_app, backend, secret='s'))
+
+@pygnite.get('/test/count')
+def count(request):
+    request.session['count'] = request.session.get('count', 0) + 1
+    return str(request.session['count'])
+
+@pygnite.get('/test/stream')
+def stream(request):
+    return template.render_stream('test_stream.html', buffer_size=3, items=range(3))
+
+@pygnite.get('/test/render')
+def render_page(request):
+    return template.render('test_stream.html', items=[1])
+
+@pygnite.get('/test/unicode')
+def unicode_page(request):
+    return u'\u017c\xf3\u0142w'
+
+@pygnite.get('/test/created')
+def created(request):
+    current.response.status = 201
+    current.response.headers['X-Request'] = current.request.path
+    return 'created'
+
+@pygnite.get('/test/flash')
+def set_flash(request):
+    request.session['flash'] = 'saved'
+    return 'ok'
+
+@pygnite.get('/test/show_flash')
+def show_flash(request):
+    return str(request.flash)
+
+@pygnite.get('/test/fail')
+def fail(request):
+    request.session['count'] = 100
+    raise ValueError('failed')
+
+@pygnite.get('/test/login')
+def login(request):
+    request.session['user'] = request.vars.user
+    return 'ok'
+
+whoami_cache = http.cached(ttl=60)
+whoami_cache.cache = MemoryCache()
+
+@pygnite.get('/test/whoami')
+@whoami_cache
+def whoami(request):
+    return 'user %s' % request.session.get('user')
+
+@pygnite.get('/test/accepted')
+def accepted(request):
+    current.response.status = 202
+    current.response.headers['X-Queue'] = '1'
+    return http.Response('accepted')
+
+@pygnite.get('/test/wsgi')
+def wsgi(request):
+    def app(env, start_response):
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return ['wsgi']
+    current.response.headers['X-Ignored'] = '1'
+    return app
+
+streamed_db = {}
+
+@pygnite.get('/test/stream_rows')
+def stream_rows(request):
+    db = streamed_db['db']
+    def rows():
+        for row in db(db.item.id > 0).select(orderby=db.item.id):
+            yield '<p>%s</p>' % row.name
+    return rows()
+
+@pygnite.get('/test/stateless', session=False)
+def stateless(request):
+    return 'stateless %s' % request.session
+
+
+class SessionBackendsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def backends(self):
+        return [CookieBackend(), MemoryBackend(), FileBackend(self.path),
+                StoreBackend(LocalStore())]
+
+    def test_session_survives_requests(self):
+        for backend in self.backends():
+            app = SessionMiddleware(counter, backend, secret='test secret')
+            (status, headers, body) = call(app)
+            self.assertEqual(body, '1')
+            cookie = cookie_of(headers)
+            (status, headers, body) = call(app, cookie)
+            self.assertEqual(body, '2', backend)
+
+    def test_forged_signature_is_ignored(self):
+        app = SessionMiddleware(counter, MemoryBackend(), secret='test secret')
+        cookie = cookie_of(call(app)[1])
+        (name, value) = cookie.split('=', 1)
+        forged = '%s=%s%s' % (name, '0' * 40, value[40:])
+        self.assertEqual(call(app, forged)[2], '1')
+
+    def test_invalidated_session_is_deleted(self):
+        backend = MemoryBackend()
+        def logout(env, start_response):
+            env[SESSION_KEY].invalidate()
+            start_response('200 OK', [])
+            return ['']
+        cookie = cookie_of(call(SessionMiddleware(counter, backend, secret='s'))[1])
+        call(SessionMiddleware(logout, backend, secret='s'), cookie)
+        self.assertEqual(backend.load(cookie.split('=', 1)[1][40:]), None)
+
+    def test_cookie_backend_needs_secret(self):
+        self.assertRaises(ValueError, SessionMiddleware, counter, CookieBackend())
+
+    def test_cookie_backend_doesnt_unpickle(self):
+        payload = base64.urlsafe_b64encode(cPickle.dumps((0, {'count': 5})))
+        self.assertEqual(CookieBackend().load(payload), None)
+
+    def test_cookie_backend_rejects_other_data(self):
+        backend = CookieBackend()
+        self.assertEqual(backend.load(base64.urlsafe_b64encode('[0, [1, 2]]')), None)
+        self.assertEqual(backend.load(backend.save('x', {'a': [1]})), {'a': [1]})
+
+    def test_session_without_dict_is_new(self):
+        session = Session('a' * 32, loader=lambda: [1, 2])
+        self.assertEqual(session.get('count'), None)
+        self.assertTrue(session.new)
+
+    def test_unchanged_session_isnt_saved(self):
+        backend = MemoryBackend()
+        def reader(env, start_response):
+            start_response('200 OK', [])
+            return [str(env[SESSION_KEY].get('count'))]
+        (status, headers, body) = call(SessionMiddleware(reader, backend, secret='s'))
+        self.assertFalse('Set-Cookie' in headers)
+        self.assertEqual(len(backend.sessions), 0)
+
+    def test_session_is_loaded_on_first_access(self):
+        backend = MemoryBackend()
+        loads = []
+        def load(id):
+            loads.append(id)
+            return MemoryBackend.load(backend, id)
+        backend.load = load
+        cookie = cookie_of(call(SessionMiddleware(counter, backend, secret='s'))[1])
+        def hello(env, start_response):
+            start_response('200 OK', [])
+            return ['hello']
+        call(SessionMiddleware(hello, backend, secret='s'), cookie)
+        self.assertEqual(loads, [])
+        call(SessionMiddleware(counter, backend, secret='s'), cookie)
+        self.assertEqual(len(loads), 1)
+
+
+    def test_change_while_streaming_is_saved(self):
+        backend = MemoryBackend()
+        def streaming(env, start_response):
+            session = env[SESSION_KEY]
+            session['count'] = 1
+            start_response('200 OK', [])
+            def body():
+                yield 'a'
+                session['flash'] = 'streamed'
+                yield 'b'
+            return body()
+        app = SessionMiddleware(streaming, backend, secret='s')
+        (status, headers, body) = call(app)
+        self.assertEqual(body, 'ab')
+        id = cookie_of(headers).split('=', 1)[1][40:]
+        self.assertEqual(backend.load(id), {'count': 1, 'flash': 'streamed'})
+
+class RoutesTest(unittest.TestCase):
+
+    def test_stateless_route_skips_session(self):
+        backend = MemoryBackend()
+        app = app_with(backend)
+        (status, headers, body) = call(app, path='/test/stateless')
+        self.assertEqual(body, 'stateless None')
+        self.assertFalse('Set-Cookie' in headers)
+        cookie = cookie_of(call(app, path='/test/count')[1])
+        self.assertEqual(call(app, cookie, path='/test/count')[2], '2')
+        self.assertEqual(call(app, cookie, path='/test/stateless')[2], 'stateless None')
+
+
+    def test_flash_is_cleared_by_next_request_using_session(self):
+        app = app_with(MemoryBackend())
+        cookie = cookie_of(call(app, path='/test/flash')[1])
+        call(app, cookie, path='/test/created')
+        self.assertEqual(call(app, cookie, path='/test/show_flash')[2], 'saved')
+        self.assertEqual(call(app, cookie, path='/test/show_flash')[2], 'None')
+        call(app, cookie, path='/test/flash')
+        call(app, cookie, path='/test/count')
+        self.assertEqual(call(app, cookie, path='/test/show_flash')[2], 'None')
+
+    def test_failed_request_doesnt_save_session(self):
+        app = app_with(MemoryBackend())
+        cookie = cookie_of(call(app, path='/test/count')[1])
+        (status, headers, body) = call(app, cookie, path='/test/fail')
+        self.assertTrue(status.startswith('500'))
+        self.assertFalse('Set-Cookie' in headers)
+        self.assertEqual(call(app, cookie, path='/test/count')[2], '2')
+
+class BeakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saves = []
+        self.save = beaker.session.Session.save
+        def save(session, accessed_only=False):
+            self.saves.append(dict(session))
+            return self.save(session, accessed_only)
+        beaker.session.Session.save = save
+
+    def tearDown(self):
+        beaker.session.Session.save = self.save
+
+    def test_only_changed_session_is_saved(self):
+        main.debug = False
+        app = main.stateless_app(main.create_app, BeakerMiddleware(
+            main.create_app, key='mysession', secret='s', type='memory',
+            environ_key=SESSION_KEY, save_accessed_time=False))
+        # beaker spells it Set-cookie
+        cookie = call(app, path='/test/count')[1]['Set-cookie'].split(';')[0]
+        self.assertEqual(len(self.saves), 1)
+        call(app, cookie, path='/test/show_flash')
+        self.assertEqual(len(self.saves), 1)
+        self.assertTrue(call(app, cookie, path='/test/fail')[0].startswith('500'))
+        self.assertEqual(len(self.saves), 1)
+        self.assertEqual(call(app, cookie, path='/test/count')[2], '2')
+        self.assertEqual(len(self.saves), 2)
+
+class TemplatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.path, 'cache')
+        for (name, source) in [('test_ok.html', 'ok {{ x }}'),
+                               ('test_broken.html', '{% if %}')]:
+            f = open(os.path.join(self.path, name), 'w')
+            f.write(source)
+            f.close()
+        self.env = (template.env.bytecode_cache, template.env.auto_reload,
+                    template.env.cache)
+        template.append_path(self.path)
+
+    def tearDown(self):
+        template.env.loader.searchpath.remove(self.path)
+        (template.env.bytecode_cache, template.env.auto_reload,
+         template.env.cache) = self.env
+        shutil.rmtree(self.path)
+
+    def test_precompiled_templates_are_cached_on_disk(self):
+        template.configure_templates(cache_path=self.cache_path, cache_size=-1)
+        self.assertTrue(template.precompile_templates() >= 1)
+        self.assertTrue(os.listdir(self.cache_path))
+        self.assertTrue('test_ok.html' in [key[1] for key in template.env.cache])
+        self.assertEqual(template.env.get_template('test_ok.html').render(x=1), 'ok 1')
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        f = open(os.path.join(self.path, 'test_stream.html'), 'w')
+        f.write('{% for i in items %}<p>{{ i }}</p>{% endfor %}')
+        f.close()
+        template.append_path(self.path)
+
+    def tearDown(self):
+        template.env.loader.searchpath.remove(self.path)
+        shutil.rmtree(self.path)
+
+    def test_template_is_streamed(self):
+        env = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/test/stream',
+               'QUERY_STRING': '', 'wsgi.input': StringIO.StringIO('')}
+        response = []
+        result = app_with(MemoryBackend())(env, lambda status, headers, exc_info=None: response.append(dict(headers)))
+        self.assertFalse(isinstance(result, list))
+        self.assertEqual(list(result), ['<p>0</p>', '<p>1</p>', '<p>2</p>'])
+        self.assertFalse('Content-length' in response[0])
+
+    def test_render_doesnt_load_session(self):
+        backend = MemoryBackend()
+        app = app_with(backend)
+        cookie = cookie_of(call(app, path='/test/count')[1])
+        backend.load = lambda id: self.fail('session loaded')
+        self.assertEqual(call(app, cookie, path='/test/render')[2], '<p>1</p>')
+
+    def test_streamed_rows_give_connection_back(self):
+        from pygnite.sql import SQLDB, SQLField
+        SQLDB._set_thread_folder(self.path)
+        db = streamed_db['db'] = SQLDB('sqlite://stream.db')
+        db.define_table('item', SQLField('name'))
+        db.item.insert(name='a')
+        db.item.insert(name='b')
+        SQLDB.close_all_instances(SQLDB.commit)
+        saved = main.finish
+        main.finish = hooks.compose_teardown()
+        try:
+            for i in range(3):
+                body = call(app_with(MemoryBackend()), path='/test/stream_rows')[2]
+                self.assertEqual(body, '<p>a</p><p>b</p>')
+                self.assertEqual(db._pool.stats()['in_use'], 0)
+        finally:
+            main.finish = saved
+            SQLDB._connection_pools.pop(db._uri)
+
+    def test_unicode_body_length(self):
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/unicode')
+        self.assertEqual(body, u'\u017c\xf3\u0142w'.encode('utf-8'))
+        self.assertEqual(headers['Content-length'], str(len(body)))
+
+
+class ErrorPagesTest(unittest.TestCase):
+
+    templates = {
+        'test_session.html': '<p>{{ session.user }}</p>',
+        'test_base.html': '<p>{{ session.user }}</p>{% block c %}{% endblock %}',
+        'test_extends.html': '{% extends "test_base.html" %}{% block c %}403{% endblock %}',
+        'test_static.html': '{% include "test_part.html" %} page',
+        'test_part.html': 'static',
+    }
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for (name, source) in self.templates.items():
+            f = open(os.path.join(self.path, name), 'w')
+            f.write(source)
+            f.close()
+        template.append_path(self.path)
+
+    def tearDown(self):
+        template.env.loader.searchpath.remove(self.path)
+        http.error_pages.clear()
+        current.clear()
+        shutil.rmtree(self.path)
+
+    def page(self, user, name):
+        current.start(request=Storage({SESSION_KEY: {'user': user}}), response=Storage())
+        return http._error_page(403, name)
+
+    def test_page_using_session_isnt_cached(self):
+        self.assertEqual(self.page('alice', 'test_session.html'), '<p>alice</p>')
+        self.assertEqual(self.page('bob', 'test_session.html'), '<p>bob</p>')
+
+    def test_page_extending_session_template_isnt_cached(self):
+        self.assertEqual(self.page('alice', 'test_extends.html'), '<p>alice</p>403')
+        self.assertEqual(self.page('bob', 'test_extends.html'), '<p>bob</p>403')
+
+    def test_static_page_is_cached(self):
+        self.assertEqual(self.page('alice', 'test_static.html'), 'static page')
+        self.assertEqual(http.error_pages[(403, 'test_static.html')][1], 'static page')
+
+    def test_error_pages_are_counted(self):
+        before = http.error_stats().get(404, 0)
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/missing')
+        self.assertTrue(status.startswith('404'))
+        self.assertEqual(http.error_stats()[404], before + 1)
+
+
+class FragmentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.fragment_cache = template.env.fragment_cache
+
+    def tearDown(self):
+        template.env.fragment_cache = self.fragment_cache
+        shutil.rmtree(self.path)
+
+    def test_fragment_is_rendered_once(self):
+        page = template.env.from_string(
+            '{% cache "menu-" ~ lang %}{{ x }}{% endcache %} {{ x }}')
+        for cache in [MemoryCache(), FileCache(self.path)]:
+            template.configure_templates(fragment_cache=cache)
+            self.assertEqual(page.render(lang='en', x=1), '1 1')
+            self.assertEqual(page.render(lang='en', x=2), '1 2')
+            self.assertEqual(page.render(lang='pl', x=3), '3 3')
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 2)
+
+
+class CachedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cached = http.cached(ttl=60, vary=['page'])
+        self.cached.cache = MemoryCache()
+        self.calls = []
+
+    def request(self, method='GET', page='1'):
+        return Storage(method=method, path='/news', vars={'page': page})
+
+    def controller(self, status=200, delay=0):
+        def call():
+            self.calls.append(1)
+            time.sleep(delay)
+            return http.Response('news', status=status)
+        return call
+
+    def test_hit_doesnt_call_controller(self):
+        self.cached.response(self.request(), self.controller())
+        response = self.cached.response(self.request(), self.controller())
+        self.assertEqual(response.body, 'news')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_vary_vars_are_part_of_key(self):
+        self.cached.response(self.request(page='1'), self.controller())
+        self.cached.response(self.request(page='2'), self.controller())
+        self.assertEqual(len(self.calls), 2)
+
+    def test_post_isnt_cached(self):
+        self.cached.response(self.request('POST'), self.controller())
+        self.cached.response(self.request('POST'), self.controller())
+        self.assertEqual(len(self.calls), 2)
+
+    def test_error_isnt_cached(self):
+        self.cached.response(self.request(), self.controller(status=500))
+        self.cached.response(self.request(), self.controller(status=500))
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_cold_miss_is_computed_once(self):
+        bodies = []
+        def worker():
+            response = self.cached.response(self.request(), self.controller(delay=0.3))
+            bodies.append(response.body)
+        threads = [threading.Thread(target=worker) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(bodies, ['news'] * 10)
+
+    def test_response_using_session_isnt_cached(self):
+        app = app_with(MemoryBackend())
+        alice = cookie_of(call(app, path='/test/login', query='user=alice')[1])
+        bob = cookie_of(call(app, path='/test/login', query='user=bob')[1])
+        self.assertEqual(call(app, alice, path='/test/whoami')[2], 'user alice')
+        self.assertEqual(call(app, bob, path='/test/whoami')[2], 'user bob')
+        self.assertEqual(whoami_cache.cache.peek('response:/test/whoami'), None)
+
+    def test_peek_doesnt_count(self):
+        cache = MemoryCache()
+        cache.set('a', 1)
+        self.assertEqual((cache.peek('a'), cache.peek('b', 2)), (1, 2))
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+class ContextTest(unittest.TestCase):
+
+    def tearDown(self):
+        current.clear()
+
+    def test_threads_see_own_values(self):
+        seen = []
+        def worker(i):
+            current.start(request=i)
+            time.sleep(0.01)
+            seen.append((i, current.request))
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(seen), [(i, i) for i in range(5)])
+        self.assertEqual(current.request, None)
+
+    def test_controller_sets_status_and_headers(self):
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/created')
+        self.assertEqual((status, body), ('201 Created', 'created'))
+        self.assertEqual(headers['X-Request'], '/test/created')
+
+
+    def test_status_is_applied_to_returned_response(self):
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/accepted')
+        self.assertEqual((status, body), ('202 Accepted', 'accepted'))
+        self.assertEqual(headers['X-Queue'], '1')
+
+    def test_controller_may_return_wsgi_app(self):
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/wsgi')
+        self.assertEqual((status, body), ('200 OK', 'wsgi'))
+        self.assertFalse('X-Ignored' in headers)
+
+class HooksTest(unittest.TestCase):
+
+    names = ('before_hooks', 'after_hooks', 'teardown_hooks', 'middlewares')
+
+    def setUp(self):
+        self.saved = [getattr(hooks, name)[:] for name in self.names]
+        for name in self.names:
+            del getattr(hooks, name)[:]
+        self.calls = []
+
+    def tearDown(self):
+        for (name, saved) in zip(self.names, self.saved):
+            getattr(hooks, name)[:] = saved
+        main.handler = main.call_controller
+        main.finish = lambda request, error: None
+
+    def register(self, name):
+        def before(request):
+            self.calls.append(name)
+        def after(request, response):
+            self.calls.append(name)
+        def teardown(request, error):
+            self.calls.append((name, error))
+        hooks.before_request(before)
+        hooks.after_request(after)
+        hooks.teardown(teardown)
+
+    def test_composition_order(self):
+        self.register('first')
+        self.register('second')
+        main.handler = hooks.compose(main.call_controller)
+        main.finish = hooks.compose_teardown()
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/created')
+        self.assertEqual(body, 'created')
+        # after hooks and teardowns run in reverse order, first registered
+        # is the outermost
+        self.assertEqual(self.calls, ['first', 'second', 'second', 'first',
+                                      ('second', None), ('first', None)])
+
+    def test_before_hook_response_skips_controller(self):
+        hooks.before_request(lambda request: 'denied')
+        hooks.after_request(lambda request, response: self.calls.append(response.body))
+        main.handler = hooks.compose(main.call_controller)
+        (status, headers, body) = call(app_with(MemoryBackend()), path='/test/created')
+        self.assertEqual((status, body), ('200 OK', 'denied'))
+        self.assertEqual(self.calls, [])
+
+    def test_first_middleware_is_outermost(self):
+        def tagging(app, tag):
+            def tagged(env, start_response):
+                return [tag] + list(app(env, start_response))
+            return tagged
+        hooks.middleware(tagging, tag='1')
+        hooks.middleware(tagging, tag='2')
+        app = hooks.wrap(app_with(MemoryBackend()))
+        self.assertEqual(call(app, path='/test/created')[2], '12created')
+
+
+if __name__ == '__main__':
+    unittest.main()